@@ -1,9 +1,35 @@
 import os
 import sys
+import stat
 import termios
 import tty
 import subprocess
 import shutil
+import mmap
+import time
+import bisect
+import heapq
+import threading
+import ctypes
+import ctypes.util
+import errno
+import queue
+import select
+import signal
+import codecs
+import struct
+import fcntl
+import hashlib
+import json
+import shlex
+import socket
+import tempfile
+import sqlite3
+import itertools
+import gc
+import warnings
+from array import array
+from collections import deque, OrderedDict
 from datetime import datetime
 
 
@@ -18,8 +44,8 @@ file_runners = {
     '.pl': 'perl',
     '.php': 'php',
     '.java': 'java',
-    '.cpp': 'g++ -o /tmp/tempexe && /tmp/tempexe',
-    '.c': 'gcc -o /tmp/tempexe && /tmp/tempexe',
+    '.cpp': 'g++',
+    '.c': 'gcc',
     '.go': 'go run',
     '.R': 'Rscript',
     '.jl': 'julia',
@@ -28,31 +54,296 @@ file_runners = {
     '.ts': 'ts-node',
     '.swift': 'swift',
     '.m': 'octave',
-    '.f90': 'gfortran -o /tmp/tempexe && /tmp/tempexe',
+    '.f90': 'gfortran',
     '.hs': 'runhaskell',
 }
 
-pli = []
+# The directory index is a parent-pointer tree held in flat arrays indexed by
+# node id; names are interned and a root's name is its full path. Ids are
+# never reused within a session, a dropped node just gets name id -1
+node_parent = array('i')
+node_name = array('i')
+node_depth = array('H')
+node_child = array('i')
+node_next = array('i')
+node_prev = array('i')
+node_mtime = array('q')
+node_names = []
+name_ids = {}
+node_roots = {}
+node_moves = 0
 leaves = []
+leaf_nodes = {}
+leaf_parents = {}
+folded_leaves = []
+folded_names = {}
+leaf_trigrams = {}
+search_ready = False
+leaves_version = 0
+fuzzy_bits = []
+fuzzy_ready = False
+crawl_pending = {}
+crawl_status = {'running': False, 'scanned': 0, 'started': 0.0}
+index_lock = threading.RLock()
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR | IN_DONT_FOLLOW
+IN_SAVE_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+libc = None
+inotify_fd = None
+inotify_queue_size = 4096
+inotify_events = queue.Queue(maxsize=inotify_queue_size)
+inotify_overflow = False
+watches_full = False
+watched = {}
+watch_paths = {}
+
+data_dir = os.path.join(os.path.expanduser('~'), '.joemama')
+index_file = os.path.join(data_dir, 'index')
+index_checkpoint_secs = 5
+walker_threads = min(8, os.cpu_count() or 1)
+ignore_case = False
+fuzzy = False
+fuzzy_limit = 500
+fuzzy_pools = []
+runner_backend = 'pty'
+job_limit = 4
+job_keep = 20
+job_output_bytes = 256 * 1024
+jobs = {}
+jobs_lock = threading.Lock()
+job_ids = itertools.count(1)
+job_events = deque()
+job_wakeup = os.pipe()
+warm_python = False
+warm_modules = ['argparse', 'collections', 'datetime', 'json', 'pathlib', 're', 'subprocess']
+warm_server = None
+warm_lock = threading.Lock()
+watch_debounce = 0.2
+copy_workers = 8
+copy_chunk = 64 << 20
+copy_block = 1 << 20
+FICLONE = 0x40049409
+watch_poll_secs = 0.25
+build_cache_dir = os.path.join(data_dir, 'build')
+build_cache_bytes = 256 << 20
+listing_cache_size = 256
+
+frecency_file = os.path.join(data_dir, 'frecency.db')
+frecency_half_life = 7 * 24 * 3600
+frecency_batch = 20
+frecency_flush_secs = 30
+frecency = {}
+frecency_pending = {}
+frecency_db = None
+frecency_last_flush = 0.0
+frecency_version = 0
+leaf_scores_cache = {}
+leaf_scores_version = None
+
+in_paste = False
+key_decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+history_file = os.path.join(data_dir, 'history')
+history_lock = history_file + '.lock'
+history_size = 1000
+history_tail_bytes = 256 * 1024
+history_compact_bytes = 1 << 20
+history_compacted = 0
+history_ring = deque(maxlen=history_size)
+history_half_life = 200  # commands
+history_search_lock = threading.Lock()
+history_ids = {}
+history_cmds = []
+history_folded = []
+history_counts = array('i')
+history_last = array('i')
+history_grams = {}
+history_order = {}
+history_peak = 0
+history_seq = 0
+history_seen = (0, 0)
 
 cmdlist = ['new', 'newdir', 'list', 'copyto', 'moveto', 'info', 'editor', 'run',
-           'currdir', 'rename', 'clear', 'remove', 'variable', 'quit', 'varlist', 'purge', 'cmd']
+           'currdir', 'rename', 'clear', 'remove', 'variable', 'quit', 'varlist', 'purge', 'cmd', 'fuzzy',
+           'stats', 'runner', 'jobs', 'fg', 'kill', 'output',
+           'warm', 'watch']
 cmdlist.sort()
 
+# History is one append-only log per user, "<count>\t<command>" per line,
+# shared by every running instance. Appends and compaction serialise on a
+# separate lock file, since compaction swaps the log's inode
+def lock_history():
+    os.makedirs(data_dir, exist_ok=True)
+    fd = os.open(history_lock, os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+def parse_history(line):
+    count, tab, command = line.partition(b'\t')
+    if tab and count.isdigit():
+        return int(count), command
+    return 1, line
+
 def read_history():
-    history = []
-    if os.path.exists('.history'):
-        with open('.history', 'r') as file:
-            history = file.readlines()
-    return history[-30:]
+    # Only the tail of the log is read into the ring, so startup does not
+    # slow down as history grows. The log is next compacted once it doubles
+    global history_compacted
+    history_ring.clear()
+    try:
+        with open(history_file, 'rb') as f:
+            size = history_compacted = f.seek(0, os.SEEK_END)
+            start = max(0, size - history_tail_bytes)
+            f.seek(start)
+            lines = f.read().split(b'\n')
+    except FileNotFoundError:
+        # Carry over the old per-directory history once
+        if os.path.exists('.history'):
+            with open('.history', 'r') as file:
+                for line in file:
+                    if line.strip():
+                        write_history(line)
+        return history_ring
+    if start:
+        lines = lines[1:]
+    for line in lines[-history_size - 1:]:
+        if line:
+            history_ring.append(parse_history(line)[1].decode('utf-8', 'replace'))
+    return history_ring
 
 def write_history(new_command):
-    history = read_history()
-    history.append(new_command.strip() + '\n')
-    history = history[-30:]
-    with open('.history', 'w') as file:
-        file.writelines(history)
-    return history
+    command = new_command.strip()
+    history_ring.append(command)
+    lock = lock_history()
+    try:
+        with open(history_file, 'ab') as f:
+            f.write(b'1\t' + command.encode('utf-8', 'surrogateescape') + b'\n')
+            size = f.tell()
+    finally:
+        os.close(lock)
+    if size > max(history_compact_bytes, 2 * history_compacted):
+        threading.Thread(target=compact_history, daemon=True).start()
+    return history_ring
+
+def compact_history():
+    # Folds every repeat of a command into one line carrying the total count,
+    # placed where the command was last used
+    global history_compacted
+    lock = lock_history()
+    try:
+        with open(history_file, 'rb') as f:
+            data = f.read()
+        if len(data) <= max(history_compact_bytes, 2 * history_compacted):
+            return
+        counts = {}
+        for line in data.split(b'\n'):
+            if line:
+                count, command = parse_history(line)
+                counts[command] = counts.pop(command, 0) + count
+        tmppath = history_file + '.tmp'
+        with open(tmppath, 'wb') as f:
+            for command, count in counts.items():
+                f.write(b'%d\t%s\n' % (count, command))
+            history_compacted = f.tell()
+        os.replace(tmppath, history_file)
+    finally:
+        os.close(lock)
+
+def note_history(command, count=1):
+    global history_seq, history_peak
+    history_seq += 1
+    i = history_ids.get(command)
+    if i is None:
+        i = history_ids[command] = len(history_cmds)
+        key = command.casefold()
+        history_cmds.append(command)
+        history_folded.append(key)
+        history_counts.append(0)
+        history_last.append(0)
+        for g in get_trigrams(key):
+            history_grams.setdefault(g, set()).add(i)
+    history_counts[i] += count
+    history_last[i] = history_seq
+    history_peak = max(history_peak, history_counts[i])
+    history_order.pop(i, None)
+    history_order[i] = None
+
+def sync_history_search():
+    # Brings the search index up to date with the log, including commands
+    # other sessions have appended. New lines are read from where the last
+    # sync stopped; after a compaction only counts above the known ones are new
+    global history_seen
+    with history_search_lock:
+        try:
+            f = open(history_file, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            ino = os.fstat(f.fileno()).st_ino
+            seen_ino, offset = history_seen
+            if ino != seen_ino:
+                offset = 0
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        lines = data[:end].split(b'\n')
+        history_seen = (ino, offset + end)
+        if ino == seen_ino:
+            for line in lines:
+                if line:
+                    count, command = parse_history(line)
+                    note_history(command.decode('utf-8', 'replace'), count)
+            return
+        totals = {}
+        for line in lines:
+            if line:
+                count, command = parse_history(line)
+                totals[command] = totals.pop(command, 0) + count
+        for command, total in totals.items():
+            command = command.decode('utf-8', 'replace')
+            i = history_ids.get(command)
+            extra = total - (history_counts[i] if i is not None else 0)
+            if extra > 0:
+                note_history(command, extra)
+
+def history_score(i):
+    return history_counts[i] * 0.5 ** ((history_seq - history_last[i]) / history_half_life)
+
+def search_history(query, k=10):
+    # Commands containing query (case-insensitive), most frecent first. A
+    # small trigram candidate set is ranked outright; otherwise commands are
+    # walked newest first until even the most used one could no longer make
+    # the top k at that age
+    key = query.casefold()
+    with history_search_lock:
+        ids = None
+        if len(key) >= 3:
+            postings = sorted((history_grams.get(g, set()) for g in get_trigrams(key)), key=len)
+            ids = postings[0].intersection(*postings[1:])
+            if len(ids) <= 1000:
+                hits = [i for i in ids if key in history_folded[i]]
+                return [history_cmds[i] for i in heapq.nlargest(k, hits, key=history_score)]
+        top = []
+        for i in reversed(history_order):
+            if len(top) == k and history_peak * 0.5 ** ((history_seq - history_last[i]) / history_half_life) <= top[0][0]:
+                break
+            if (ids is None or i in ids) and key in history_folded[i]:
+                item = (history_score(i), -i)
+                if len(top) < k:
+                    heapq.heappush(top, item)
+                elif item > top[0]:
+                    heapq.heapreplace(top, item)
+        return [history_cmds[-i] for _, i in sorted(top, reverse=True)]
 
 def help_():
     doc = '''
@@ -71,9 +362,16 @@ Enter `..` to go back to the parent directory\r
 
 Navigate through previous commands using `up arrow` and `down arrow`\r
 
+History is kept in `~/.joemama/history` and shared between open sessions\r
+
+Press `ctrl-r` to search the whole history as you type; `ctrl-r` again steps to the next match, `return` or `tab` puts it on the prompt and `ctrl-g` cancels\r
+
 Use `-> <dirname>` to jump to an existing directory anywhere inside the current directory\r
 Variables can be used in place of directory names\r
 Commands cannot be used while jumping\r
+If several directories share the name, the most frecent one is picked\r
+
+Suggestions list frequently and recently visited directories first\r
 
 Access commands -> `::`\r
 
@@ -84,32 +382,45 @@ cmd\r
 copyto\r
 currdir\r
 editor\r
+fg\r
+fuzzy\r
 info\r
+jobs\r
+kill\r
 list\r
 moveto\r
 new\r
 newdir\r
+output\r
 purge\r
 quit\r
 remove\r
 rename\r
 run\r
+runner\r
+stats\r
 variable\r
 varlist\r
+warm\r
+watch\r
 
 clear - clear screen\r
 Usage: `::clear`\r
 
-cmd - run custom bash command in new terminal\r
+cmd - run custom shell command, streaming its output with exit status and wall time\r
 Usage: `::cmd >> <bash command>`\r
 
 Command runs in current directory by default\r
 To run in a different directory use `cd <dirname> &&` before running the command\r
 Example:\r
 `::cmd >> cd path/to/preferred/directory && <bash command>`\r
+\r
+End the command with `&` to run it as a background job\r
 
 copyto - copy file or contents of directory to new file or directory\r
 Usage: `<filename>::copyto >> <destination>`\r
+\r
+Copies run in parallel with a live progress and throughput line; `ctrl-c` cancels\r
 
 currdir - display path to current directory\r
 Usage: `::currdir`\r
@@ -117,9 +428,23 @@ Usage: `::currdir`\r
 editor - open file or directory in preferred editor\r
 Usage: `<filename>::editor >> <file editor>`\r
 
+fg - bring a job to the foreground, `ctrl-z` sends it back\r
+Usage: `::fg` or `::fg >> <job id>`\r
+\r
+fuzzy - toggle fuzzy matching for suggestions and jumps\r
+Usage: `::fuzzy`\r
+
+Letters can be skipped, e.g. `jmm` matches `joemama`\r
+
 info - display file or directory information\r
 Usage: `<filename>::info`\r
 
+jobs - list jobs, or set how many run at once (default 4, the rest wait)\r
+Usage: `::jobs` or `::jobs >> <limit>`\r
+\r
+kill - stop a job; killing it again forces it\r
+Usage: `::kill >> <job id>`\r
+\r
 list - list all files and directories in directory\r
 Usage: `<dirname>::list` or `::list`\r
 
@@ -132,6 +457,9 @@ Usage: `<filename>::new`\r
 newdir - create new directory\r
 Usage: `<dirname>::newdir`\r
 
+output - show the latest output of a job\r
+Usage: `::output >> <job id>`\r
+\r
 purge - remove existing directory and its contents\r
 Usage: `<dirname>::purge`\r
 
@@ -146,6 +474,18 @@ Usage: `<filename or dirname>::rename >> <newfilename or newdirname>`\r
 
 run - run a script\r
 Usage: `<filename>::run`\r
+\r
+C, C++ and Fortran sources are compiled once and reused from `~/.joemama/build` until they change\r
+\r
+Use `<filename>::run >> &` to run it as a background job\r
+\r
+Press `ctrl-c` to interrupt a running command or script, or `ctrl-z` to move it to the background\r
+\r
+runner - choose where commands and scripts run: `pty` (default) streams output here, `terminal` opens a Terminal.app window\r
+Usage: `::runner >> pty` or `::runner >> terminal`\r
+
+stats - display directory listing cache hits and misses\r
+Usage: `::stats`\r
 
 variable - create and set variable with custom value\r
 Usage: `::variable >> <varname> >> <value>`\r
@@ -166,118 +506,1364 @@ User defined variables get cleared after every session\r
 varlist - list all variables\r
 Usage: `::varlist`\r
 
+warm - toggle running Python scripts in a warm worker that has already imported common modules, or choose the modules to preload\r
+Usage: `::warm` or `::warm >> <module>, <module>, ...`\r
+
+watch - run a script and run it again every time it (or another listed file) is saved, showing how long each run took; `ctrl-c` stops\r
+Usage: `<filename>::watch` or `<filename>::watch >> <file>, <file>, ...`\r
+
 '''
     sys.stdout.write(doc)
     sys.stdout.flush()
 
 def get_leaf(x):
-    return x.split('/')[-1]
+    return x.rpartition('/')[2]
+
+class SortedList:
+    # Sorted strings split into buckets of load to 2 * load items, with each
+    # bucket's last item in maxes: an insert or delete is a bisect over maxes
+    # plus one inside a bucket, and only that bucket's items move
+    load = 512
+
+    def __init__(self, items=()):
+        self.build(sorted(items))
+
+    def build(self, items):
+        self.buckets = [items[i:i + self.load] for i in range(0, len(items), self.load)]
+        self.maxes = [b[-1] for b in self.buckets]
+        self.size = len(items)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.buckets)
+
+    def irange(self, key):
+        # Items from the first one >= key onwards
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            return iter(())
+        j = bisect.bisect_left(self.buckets[i], key)
+        rest = itertools.chain.from_iterable(itertools.islice(self.buckets, i + 1, None))
+        return itertools.chain(itertools.islice(self.buckets[i], j, None), rest)
+
+    def add(self, item):
+        if not self.buckets:
+            self.build([item])
+            return
+        i = bisect.bisect_left(self.maxes, item)
+        if i == len(self.maxes):
+            i -= 1
+            self.buckets[i].append(item)
+            self.maxes[i] = item
+        else:
+            bisect.insort(self.buckets[i], item)
+        b = self.buckets[i]
+        if len(b) > 2 * self.load:
+            half = len(b) // 2
+            self.buckets[i:i + 1] = [b[:half], b[half:]]
+            self.maxes[i:i + 1] = [b[half - 1], b[-1]]
+        self.size += 1
+
+    def remove(self, item):
+        i = bisect.bisect_left(self.maxes, item)
+        b = self.buckets[i]
+        del b[bisect.bisect_left(b, item)]
+        if b:
+            self.maxes[i] = b[-1]
+        else:
+            del self.buckets[i]
+            del self.maxes[i]
+        self.size -= 1
+
+    def update(self, items):
+        # Big batches are merged in one pass (timsort sees two sorted runs)
+        if len(items) * 16 > self.size:
+            self.build(sorted(itertools.chain(self, items)))
+        else:
+            for item in items:
+                self.add(item)
 
-def update_leaves():
-    global pli, leaves
-    dirli = set(list(map(get_leaf, pli)))
-    leaves = list(dirli)
-    leaves.sort()
+    def difference_update(self, items):
+        if len(items) * 16 > self.size:
+            items = set(items)
+            self.build([x for x in self if x not in items])
+        else:
+            for item in items:
+                self.remove(item)
+
+def intern_name(name):
+    i = name_ids.get(name)
+    if i is None:
+        i = name_ids[name] = len(node_names)
+        node_names.append(name)
+    return i
+
+def node_leaf(n):
+    name = node_names[node_name[n]]
+    return get_leaf(name) if node_parent[n] < 0 else name
+
+def node_path(n):
+    parts = [None] * (node_depth[n] + 1)
+    for i in range(len(parts) - 1, -1, -1):
+        parts[i] = node_names[node_name[n]]
+        n = node_parent[n]
+    return '/'.join(parts) or '/'
+
+def link_node(n):
+    # Makes n its parent's first child, or registers it as a root
+    parent = node_parent[n]
+    node_prev[n] = -1
+    if parent >= 0:
+        first = node_child[parent]
+        node_next[n] = first
+        if first >= 0:
+            node_prev[first] = n
+        node_child[parent] = n
+    else:
+        node_next[n] = -1
+        node_roots[node_path(n)] = n
+
+def unlink_node(n):
+    parent, prev, nxt = node_parent[n], node_prev[n], node_next[n]
+    if prev >= 0:
+        node_next[prev] = nxt
+    elif parent >= 0:
+        node_child[parent] = nxt
+    if nxt >= 0:
+        node_prev[nxt] = prev
+    if parent < 0:
+        node_roots.pop(node_path(n), None)
+
+def link_leaf(n, fresh=None):
+    # Leaf arrays are kept sorted by parent id, with the parent ids alongside
+    # in leaf_parents, so child_node can bisect them; their length is the
+    # leaf's reference count. A leaf gaining its first node goes to fresh
+    # when the caller batches, else straight to add_leaves
+    leaf = node_leaf(n)
+    same = leaf_nodes.get(leaf)
+    if same is None:
+        leaf_nodes[leaf] = array('i', (n,))
+        leaf_parents[leaf] = array('i', (node_parent[n],))
+        if fresh is None:
+            add_leaves([leaf])
+        else:
+            fresh.append(leaf)
+    else:
+        parents = leaf_parents[leaf]
+        i = bisect.bisect_right(parents, node_parent[n])
+        same.insert(i, n)
+        parents.insert(i, node_parent[n])
+
+def unlink_leaf(n, gone=None):
+    leaf = node_leaf(n)
+    same = leaf_nodes[leaf]
+    parents = leaf_parents[leaf]
+    i = bisect.bisect_left(parents, node_parent[n])
+    while same[i] != n:
+        i += 1
+    del same[i]
+    del parents[i]
+    if not same:
+        del leaf_nodes[leaf]
+        del leaf_parents[leaf]
+        if gone is None:
+            remove_leaves([leaf])
+        else:
+            gone.append(leaf)
+
+def make_node(parent, name, mtime=0):
+    # Appends a node under parent; the leaf index is left to the caller
+    n = len(node_parent)
+    node_parent.append(parent)
+    node_name.append(intern_name(name))
+    node_depth.append(node_depth[parent] + 1 if parent >= 0 else 0)
+    node_child.append(-1)
+    node_next.append(-1)
+    node_prev.append(-1)
+    node_mtime.append(mtime)
+    link_node(n)
+    return n
+
+def new_node(parent, name, mtime=0, fresh=None):
+    n = make_node(parent, name, mtime)
+    link_leaf(n, fresh)
+    return n
+
+def drop_node(n):
+    # Unlinks n from its parent and frees its whole subtree, watches included
+    unlink_node(n)
+    gone = []
+    stack = [n]
+    while stack:
+        m = stack.pop()
+        c = node_child[m]
+        while c >= 0:
+            stack.append(c)
+            c = node_next[c]
+        unlink_leaf(m, gone)
+        wd = watched.pop(m, None)
+        if wd is not None:
+            watch_paths.pop(wd, None)
+            libc.inotify_rm_watch(inotify_fd, wd)
+        node_name[m] = -1
+    remove_leaves(gone)
+
+def subtree_paths(n, path):
+    # (node, path) for n and everything below it, paths built top-down
+    stack = [(n, path)]
+    while stack:
+        m, p = stack.pop()
+        yield m, p
+        c = node_child[m]
+        while c >= 0:
+            stack.append((c, os.path.join(p, node_names[node_name[c]])))
+            c = node_next[c]
+
+def dest_parent(dest):
+    # Parent node and name for a new entry at dest; outside every root dest
+    # becomes a root named by its full path
+    if find_root(dest)[1] < 0:
+        return -1, dest.rstrip('/')
+    head, _, name = dest.rpartition('/')
+    return add_path(head or '/'), name
+
+def move_subtree(src, dest):
+    # Relinks src's node under dest's parent; descendants keep their nodes and
+    # only get their depth refreshed. Returns the moved crawl frontier paths,
+    # or None when src was not indexed
+    global node_moves
+    n = find_node(src)
+    if n < 0:
+        return None
+    moved = {}
+    if crawl_pending:
+        for m, p in subtree_paths(n, src):
+            if p in crawl_pending:
+                moved[dest + p[len(src):]] = crawl_pending.pop(p)
+    old = find_node(dest)
+    if old >= 0 and old != n:
+        drop_node(old)
+    parent, name = dest_parent(dest)
+    gone, fresh = [], []
+    unlink_leaf(n, gone)
+    unlink_node(n)
+    node_parent[n] = parent
+    node_name[n] = intern_name(name)
+    link_node(n)
+    link_leaf(n, fresh)
+    remove_leaves(sorted(set(gone) - set(fresh)))
+    add_leaves(sorted(set(fresh) - set(gone)))
+    stack = [n]
+    while stack:
+        m = stack.pop()
+        p = node_parent[m]
+        node_depth[m] = node_depth[p] + 1 if p >= 0 else 0
+        c = node_child[m]
+        while c >= 0:
+            stack.append(c)
+            c = node_next[c]
+    node_moves += 1
+    crawl_pending.update(moved)
+    return list(moved)
+
+def clone_subtree(src, dest):
+    # Copies src's subtree to dest node for node. Clones start with mtime 0
+    # so the next revalidation relists them, and each is watched like a
+    # crawled dir; dirs still on the crawl frontier under src are queued
+    # under dest too. Returns those paths, or None when src was not indexed
+    n = find_node(src)
+    if n < 0 or dest.startswith(src.rstrip('/') + '/'):
+        return None
+    old = find_node(dest)
+    if old >= 0:
+        drop_node(old)
+    parent, name = dest_parent(dest)
+    queued = []
+    fresh = []
+    stack = [(n, new_node(parent, name, fresh=fresh), dest)]
+    while stack:
+        m, copy, path = stack.pop()
+        watch_dir(path, copy)
+        if src + path[len(dest):] in crawl_pending:
+            crawl_pending[path] = copy
+            queued.append(path)
+        c = node_child[m]
+        while c >= 0:
+            name = node_names[node_name[c]]
+            stack.append((c, new_node(copy, name, fresh=fresh), os.path.join(path, name)))
+            c = node_next[c]
+    add_leaves(fresh)
+    return queued
+
+def child_node(parent, name):
+    parents = leaf_parents.get(name)
+    if parents is None:
+        return -1
+    i = bisect.bisect_left(parents, parent)
+    if i < len(parents) and parents[i] == parent and parent >= 0:
+        return leaf_nodes[name][i]
+    return -1
+
+def find_root(path):
+    for root, n in node_roots.items():
+        if path == root or path.startswith(root.rstrip('/') + '/'):
+            return root, n
+    return None, -1
+
+def find_node(path):
+    root, n = find_root(path)
+    if n >= 0 and len(path) > len(root):
+        for name in path[len(root.rstrip('/')) + 1:].split('/'):
+            n = child_node(n, name)
+            if n < 0:
+                break
+    return n
+
+def add_path(path):
+    # Missing ancestors under an indexed root are created on the way down; a
+    # path outside every root becomes a root of its own
+    root, n = find_root(path)
+    if n < 0:
+        n = new_node(-1, path.rstrip('/'))
+    elif len(path) > len(root):
+        for name in path[len(root.rstrip('/')) + 1:].split('/'):
+            c = child_node(n, name)
+            n = c if c >= 0 else new_node(n, name)
+    return n
+
+def live_nodes():
+    return (n for n in range(len(node_name)) if node_name[n] >= 0)
 
-def check_all_dirs(query, paths):
-    pathli = []
+def update_leaves():
+    # Node ids from a snapshot are breadth-first, so appending in id order
+    # leaves every leaf array sorted by parent id
+    global leaves, leaf_nodes, leaf_parents, folded_leaves, folded_names, search_ready
+    leaf_nodes = {}
+    leaf_parents = {}
+    folded_leaves = SortedList()
+    folded_names = {}
+    for n in live_nodes():
+        leaf = node_leaf(n)
+        same = leaf_nodes.get(leaf)
+        if same is None:
+            leaf_nodes[leaf] = array('i', (n,))
+            leaf_parents[leaf] = array('i', (node_parent[n],))
+        else:
+            same.append(n)
+            leaf_parents[leaf].append(node_parent[n])
+    leaves = SortedList(leaf_nodes)
+    search_ready = False
+
+def get_trigrams(key):
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+def build_leaf_search():
+    # Case-folded keys and trigram postings (keyed on folded text so one index
+    # serves both case modes) are built off the main thread since they touch
+    # every leaf; until then check_all_dirs sticks to exact-case scans
+    global folded_leaves, folded_names, leaf_trigrams, search_ready
+    with index_lock:
+        folded_names = {}
+        leaf_trigrams = {}
+        for leaf in leaves:
+            key = leaf.casefold()
+            folded_names.setdefault(key, []).append(leaf)
+            for g in get_trigrams(key):
+                leaf_trigrams.setdefault(g, set()).add(leaf)
+        folded_leaves = SortedList(folded_names)
+        search_ready = True
+
+def add_leaves(batch):
+    # Leaves that just gained their first node; the sorted lists take the
+    # whole batch in one merge, the postings one leaf at a time
+    global leaves_version
+    if not batch:
+        return
+    leaves_version += 1
+    leaves.update(batch)
+    keys = []
+    for leaf in batch:
+        key = leaf.casefold()
+        names = folded_names.get(key)
+        if names is None:
+            folded_names[key] = [leaf]
+            keys.append(key)
+        else:
+            bisect.insort(names, leaf)
+        for g in get_trigrams(key):
+            leaf_trigrams.setdefault(g, set()).add(leaf)
+        if fuzzy_ready:
+            for b in mask_bits(char_mask(leaf)):
+                fuzzy_bits[b].add(leaf)
+    folded_leaves.update(keys)
+
+def remove_leaves(batch):
+    # Leaves whose last node went away
+    global leaves_version
+    if not batch:
+        return
+    leaves_version += 1
+    leaves.difference_update(batch)
+    keys = []
+    for leaf in batch:
+        key = leaf.casefold()
+        names = folded_names.get(key)
+        if names is not None and leaf in names:
+            names.remove(leaf)
+            if not names:
+                del folded_names[key]
+                keys.append(key)
+        for g in get_trigrams(key):
+            posting = leaf_trigrams.get(g)
+            if posting is not None:
+                posting.discard(leaf)
+                if not posting:
+                    del leaf_trigrams[g]
+        if fuzzy_ready:
+            for b in mask_bits(char_mask(leaf)):
+                fuzzy_bits[b].discard(leaf)
+    folded_leaves.difference_update(keys)
+
+def is_indexed(path):
+    return find_node(path) >= 0
+
+def index_paths(paths):
+    # Callers hold index_lock; the tree, leaf_nodes and the leaf search
+    # structures move together
     for p in paths:
-        if p.startswith(query):
-            pathli.append(p)
-    others = [x for x in paths if x not in pathli and query in x]
-    pathli.sort()
-    pathli.extend(others)
-    return pathli
-
-def check_dirs(query, paths):
+        add_path(p)
+
+def check_all_dirs(query, k=10):
+    # Prefix hits come from a bisect over the sorted leaves, the rest from the
+    # trigram postings (or an early-exit scan for queries under 3 chars)
+    folded = ignore_case and search_ready
+    if folded:
+        key, keys = query.casefold(), folded_leaves
+    else:
+        key, keys = query, leaves
     pathli = []
-    for p in paths:
-        if p.startswith(query):
-            pathli.append(p)
-    others = [x for x in paths if x not in pathli and query in x]
-    pathli.sort()
-    pathli.extend(others)
+    for leaf in keys.irange(key):
+        if len(pathli) >= k or not leaf.startswith(key):
+            break
+        pathli.extend(folded_names.get(leaf, ()) if folded else [leaf])
+    pathli = pathli[:k]
+    need = k - len(pathli)
+    if need <= 0 or key == '':
+        return pathli
+
+    def is_other(leaf):
+        leaf = leaf.casefold() if folded else leaf
+        return key in leaf and not leaf.startswith(key)
+
+    if len(key) >= 3 and search_ready:
+        postings = sorted((leaf_trigrams.get(g, set()) for g in get_trigrams(key.casefold())), key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        # A dense candidate set is cheaper to meet by walking the sorted
+        # leaves and stopping at k than by heap-selecting over all of it
+        if len(candidates) * 16 < len(leaves):
+            order = str.casefold if folded else None
+            pathli.extend(heapq.nsmallest(need, filter(is_other, candidates), key=order))
+            return pathli
+    if need:
+        if folded:
+            ordered = (leaf for f in folded_leaves for leaf in folded_names.get(f, ()))
+        else:
+            ordered = leaves
+        for leaf in ordered:
+            if is_other(leaf):
+                pathli.append(leaf)
+                need -= 1
+                if need == 0:
+                    break
     return pathli
 
-def check_cmd(command, cmdlist):
-    cmdli = []
-    for c in cmdlist:
-        if c.startswith(command):
-            cmdli.append(c)
-    others = [x for x in cmdlist if x not in cmdli and command in x]
-    cmdli.sort()
-    cmdli.extend(others)
-    return cmdli
-
-def clear_current_line():
-    sys.stdout.write('\0338\033[0J')
-    sys.stdout.flush()
+def top_matches(query, candidates, k=10, presorted=False):
+    # Shared matcher for paths, commands and variables: sorted prefix hits
+    # first, then other substring hits in input order, at most k in total.
+    # Presorted input lets the prefix hits be sliced out with bisect
+    if presorted:
+        lo = hi = bisect.bisect_left(candidates, query)
+        while hi < len(candidates) and hi - lo < k and candidates[hi].startswith(query):
+            hi += 1
+        prefix = candidates[lo:hi]
+    else:
+        prefix = heapq.nsmallest(k, {c for c in candidates if c.startswith(query)})
+    need = k - len(prefix)
+    if need <= 0:
+        return prefix
+    others = []
+    seen = set()
+    for c in candidates:
+        if query in c and c not in seen and not c.startswith(query):
+            seen.add(c)
+            others.append(c)
+            if len(others) == need:
+                break
+    return prefix + others
+
+def leaf_candidates(query):
+    # Sorted leaves containing query, seeded from the trigram postings
+    if search_ready and len(query) >= 3:
+        postings = sorted((leaf_trigrams.get(g, set()) for g in get_trigrams(query.casefold())), key=len)
+        return sorted(c for c in postings[0].intersection(*postings[1:]) if query in c)
+    return [c for c in leaves if query in c]
+
+class MatchSession:
+    # Keeps a stack of per-query levels so typing a character only filters
+    # the previous query's survivors and backspace pops back to a cached
+    # level. Levels are filled lazily, a chunk at a time, only as far as
+    # needed for k results. Each level scans a list of [source, pos, end]
+    # segments: a child starts from whatever its parent has matched so far
+    # and then continues from wherever the parent stopped. Candidate order is
+    # kept so prefix hits can still be bisected out of the sorted base
+    chunk = 2048
+
+    def __init__(self, candidates=None, presorted=False, seed=None, version=None):
+        self.candidates = candidates
+        self.presorted = presorted
+        self.seed = seed
+        self.version = version
+        self.seen_version = version() if version else None
+        self.levels = []
+        self.masks = None
+
+    def fill(self, i, want):
+        level = self.levels[i]
+        segments = level['segments']
+        while len(level['items']) < want and segments:
+            seg = segments[0]
+            part = seg[0][seg[1]:min(seg[1] + self.chunk, seg[2])]
+            if not part:
+                segments.pop(0)
+                continue
+            seg[1] += len(part)
+            level['items'].extend([c for c in part if level['query'] in c])
+
+    def level(self, query):
+        if self.version and self.version() != self.seen_version:
+            self.seen_version = self.version()
+            self.levels = []
+        while self.levels and not query.startswith(self.levels[-1]['query']):
+            self.levels.pop()
+        if self.levels and self.levels[-1]['query'] == query:
+            return len(self.levels) - 1
+        if self.levels:
+            parent = self.levels[-1]
+            segments = [[parent['items'], 0, len(parent['items'])]]
+            segments.extend(list(seg) for seg in parent['segments'])
+            self.levels.append({'query': query, 'items': [], 'segments': segments})
+        elif self.seed:
+            self.levels.append({'query': query, 'items': self.seed(query), 'segments': []})
+        else:
+            cands = self.candidates
+            self.levels.append({'query': query, 'items': [], 'segments': [[cands, 0, len(cands)]]})
+        return len(self.levels) - 1
+
+    def fuzzy(self, query, k=10):
+        if self.masks is None:
+            self.masks = [char_mask(c) for c in self.candidates]
+        return fuzzy_matches(query, self.candidates, self.masks, k)
+
+    def match(self, query, k=10):
+        i = self.level(query)
+        items = self.levels[i]['items']
+        if not self.presorted:
+            self.fill(i, float('inf'))
+            return top_matches(query, items, k)
+        base = self.candidates if self.candidates is not None else self.levels[0]['items']
+        lo = hi = bisect.bisect_left(base, query)
+        while hi < len(base) and hi - lo < k and base[hi].startswith(query):
+            hi += 1
+        pathli = base[lo:hi]
+        need = k - len(pathli)
+        j = 0
+        while need > 0:
+            if j == len(items):
+                self.fill(i, j + 1)
+                if j == len(items):
+                    break
+            c = items[j]
+            j += 1
+            if not c.startswith(query):
+                pathli.append(c)
+                need -= 1
+        return pathli
+
+def match_leaves(session, query):
+    # Short queries are served straight from the leaf index; longer ones
+    # narrow incrementally from a trigram seeded candidate set
+    if ignore_case or len(query) < 3:
+        return check_all_dirs(query)
+    return session.match(query)
+
+def char_mask(text):
+    # 64-bit set of the (case-folded) characters in text: a-z and 0-9 get a
+    # bit each, everything else shares the remaining 28 by code point
+    m = 0
+    for ch in set(text.casefold()):
+        if 'a' <= ch <= 'z':
+            m |= 1 << (ord(ch) - 97)
+        elif '0' <= ch <= '9':
+            m |= 1 << (ord(ch) - 22)
+        else:
+            m |= 1 << (36 + ord(ch) % 28)
+    return m
+
+def mask_bits(m):
+    return [b for b in range(64) if m >> b & 1]
+
+def fuzzy_score(query, name):
+    # fzf style scoring of query as a case-insensitive subsequence of name:
+    # matched chars score, word boundaries and runs of consecutive matches
+    # earn bonuses, gaps cost. None when query isn't a subsequence
+    if name.isascii():
+        text = name.lower()
+        at = range(len(name))
+    else:
+        # Casefolding can lengthen a character (ß -> ss), so each folded
+        # position keeps the index of the character it came from
+        folded = [ch.casefold() for ch in name]
+        text = ''.join(folded)
+        at = [i for i, f in enumerate(folded) for _ in f]
+    q = query.casefold()
+    pos = 0
+    for ch in q:
+        pos = text.find(ch, pos) + 1
+        if not pos:
+            return None
+    end = pos
+    # Walk back from the end of the first full match for the tightest start
+    qi = len(q) - 1
+    start = end - 1
+    while qi >= 0:
+        if text[start] == q[qi]:
+            qi -= 1
+        start -= 1
+    start += 1
+    score = 0
+    qi = 0
+    run = 0
+    run_bonus = 0
+    for j in range(start, end):
+        if qi < len(q) and text[j] == q[qi]:
+            i = at[j]
+            prev = name[i - 1] if i else '/'
+            if prev in '/_-. ':
+                bonus = 8
+            elif prev.islower() and name[i].isupper() or not prev.isdigit() and name[i].isdigit():
+                bonus = 7
+            else:
+                bonus = 0
+            if run:
+                # A consecutive run keeps the bonus its first char earned
+                bonus = max(bonus, run_bonus, 4)
+            else:
+                run_bonus = bonus
+            score += 16 + (bonus * 2 if qi == 0 else bonus)
+            run += 1
+            qi += 1
+        else:
+            score -= 3 if run else 1
+            run = 0
+    return score
+
+def fuzzy_rank(query, candidates, k=10):
+    scored = []
+    for c in candidates:
+        score = fuzzy_score(query, c)
+        if score is not None:
+            scored.append((-score, len(c), c))
+    return [c for _, _, c in heapq.nsmallest(k, scored)]
+
+def fuzzy_matches(query, candidates, masks, k=10):
+    qm = char_mask(query)
+    return fuzzy_rank(query, [c for c, m in zip(candidates, masks) if m & qm == qm], k)
+
+def build_fuzzy_index():
+    # Per-leaf character masks stored bit-sliced: one set of leaves per mask
+    # bit, so rejecting leaves that lack a query character is a C-level set
+    # intersection instead of a Python loop over every mask
+    global fuzzy_bits, fuzzy_ready
+    with index_lock:
+        if fuzzy_ready:
+            return
+        fuzzy_bits = [set() for _ in range(64)]
+        for leaf in leaves:
+            for b in mask_bits(char_mask(leaf)):
+                fuzzy_bits[b].add(leaf)
+        fuzzy_ready = True
+    gc.freeze()
+
+def fuzzy_leaves(query, k=10):
+    if not fuzzy_ready:
+        return check_all_dirs(query, k)
+    qm = char_mask(query)
+    # The posting sets change under the crawler and inotify threads, so the
+    # pool is built under index_lock
+    with index_lock:
+        # fuzzy_pools holds complete pools for shorter queries; a query that
+        # only gained characters narrows the last one instead of starting over
+        cache = fuzzy_pools
+        while cache and (cache[-1][0] & qm != cache[-1][0] or cache[-1][2] != leaves_version):
+            cache.pop()
+        if cache:
+            base_mask, base, _ = cache[-1]
+            pool = base.intersection(*(fuzzy_bits[b] for b in mask_bits(qm & ~base_mask)))
+            complete = True
+        else:
+            sets = sorted((fuzzy_bits[b] for b in mask_bits(qm)), key=len)
+            if not sets:
+                return []
+            rarest, others = sets[0], sets[1:]
+            expected = len(rarest)
+            for posting in others:
+                expected *= len(posting) / max(len(leaves), 1)
+            if expected < fuzzy_limit * 4:
+                # Sparse conjunction: a full C-level intersection beats scanning
+                # the rarest set in Python, and the result can be cached
+                pool = rarest.intersection(*others)
+                complete = True
+            else:
+                # Dense bits: test membership lazily and stop once enough are found
+                lazy = (x for x in rarest if all(x in posting for posting in others))
+                pool = set(itertools.islice(lazy, fuzzy_limit + 1))
+                complete = len(pool) <= fuzzy_limit
+        if complete and (not cache or cache[-1][0] != qm):
+            cache.append((qm, pool, leaves_version))
+    # Exact hits are always scored, a bounded slice of the rest on top
+    candidates = set(check_all_dirs(query, k))
+    candidates.update(itertools.islice(pool, fuzzy_limit))
+    return fuzzy_rank(query, candidates, k)
+
+def suggest_paths(query, session, scores):
+    if fuzzy:
+        return session.fuzzy(query)
+    return frecency_rank(query, session.match(query), scores)
+
+def suggest_leaves(query, session):
+    if fuzzy:
+        return fuzzy_leaves(query)
+    return frecency_rank(query, match_leaves(session, query), leaf_scores())
+
+class Renderer:
+    # The prompt line is drawn relative to a saved cursor position (DECSC).
+    # draw() only queues a frame; flush() writes it, starting at the first
+    # column that differs from what is on screen, so a burst of keys costs
+    # one write. Frames are cut to the terminal width so they never wrap
+    frame_secs = 1 / 60
+
+    def __init__(self):
+        self.width = shutil.get_terminal_size().columns
+        self.shown = ''
+        self.source = ''
+        self.pending = None
+        self.last_write = 0.0
+        self.idle = False
+
+    def anchor(self):
+        # Start a fresh prompt line at the cursor
+        sys.stdout.write('\r\0337')
+        sys.stdout.flush()
+        self.shown = ''
+        self.pending = None
+
+    def draw(self, text):
+        self.pending = text
+
+    def due(self):
+        return time.monotonic() - self.last_write >= self.frame_secs
+
+    def flush(self):
+        if self.pending is None:
+            return
+        self.source, self.pending = self.pending, None
+        text = self.source[:max(self.width - 1, 1)]
+        if text == self.shown:
+            return
+        n = len(os.path.commonprefix([text, self.shown]))
+        move = f'\033[{n}C' if n else ''
+        sys.stdout.write(f'\0338{move}{text[n:]}\033[0J')
+        sys.stdout.flush()
+        self.shown = text
+        self.last_write = time.monotonic()
+
+    def notice(self, text):
+        # A line printed above the prompt, which is then drawn again below it
+        sys.stdout.write(f'\0338\033[0J{text}\n\r\0337')
+        self.shown = ''
+        if self.pending is None:
+            self.pending = self.source
+        self.flush()
+
+    def resize(self, signum=None, frame=None):
+        self.width = shutil.get_terminal_size().columns
+        if self.pending is None:
+            self.pending = self.source
+        self.shown = ''
+        if self.idle:
+            self.flush()
+
+renderer = Renderer()
 
 def display_cmdlist(cm, cmds, display):
-    clear_current_line()
     if cmds:
         suggestions_str = ' | '.join(cmds[:10])
         total = f"{display}{cm} [{suggestions_str}]"
     else:
         total = f"{display}{cm}"
-    sys.stdout.write(total)
-    sys.stdout.flush()
+    renderer.draw(total)
 
 def display_varlist(v_, vli_, display):
-    clear_current_line()
     if vli_:
         suggestions_str = ' | '.join(vli_[:10])
         total = f"{display}{v_} [{suggestions_str}]"
     else:
         total = f"{display}{v_}"
-    sys.stdout.write(total)
-    sys.stdout.flush()
+    renderer.draw(total)
+
+def display_history(search, hits, pick):
+    if hits:
+        others = [h for i, h in enumerate(hits[:10]) if i != pick]
+        total = f"(history)'{search}': {hits[pick]}"
+        if others:
+            total += f" [{' | '.join(others)}]"
+    else:
+        total = f"(history)'{search}':"
+    renderer.draw(total)
 
-def display_pathlist(query, paths, currpath):
-    clear_current_line()
+def display_pathlist(query, paths, currpath, records=None):
     query = currpath + '%||%' + query if query else currpath + '%||%'
     query_curr = query.split('%||%')
     par, chi = query_curr[-2], query_curr[-1]
     parli = par.split('/')
     par = parli[-2].strip() + '/' + parli[-1].strip()
     if paths:
-        suggestions_str = ' | '.join(paths[:10])
+        if records:
+            suggestions_str = ' | '.join(records[p].label() if p in records else p for p in paths[:10])
+        else:
+            suggestions_str = ' | '.join(paths[:10])
         disp = f"{par}/{chi} [{suggestions_str}]"
     else:
         disp = f"{par}/{chi}"
-    sys.stdout.write(disp)
-    sys.stdout.flush()
+    if chi.strip().startswith('->') and crawl_status['running']:
+        disp += f" (still indexing {crawl_rate()} dirs/s)"
+    renderer.draw(disp)
     return disp
 
+def escape_end(text, i):
+    # End of the escape sequence starting at text[i], None if it is cut short
+    if i + 1 >= len(text):
+        return None
+    if text[i + 1] == '[':
+        j = i + 2
+        while j < len(text) and not '@' <= text[j] <= '~':
+            j += 1
+        return j + 1 if j < len(text) else None
+    if text[i + 1] == 'O':
+        return i + 3 if i + 2 < len(text) else None
+    return i + 2
+
+def read_keys(fd):
+    # Drains everything the tty has queued and splits it into keys: single
+    # characters, and escape sequences as whole strings. Inside a bracketed
+    # paste control characters are dropped, so a pasted newline never
+    # submits. Returns None at end of input
+    global in_paste
+    text = ''
+    keys = []
+    while True:
+        data = os.read(fd, 4096)
+        if not data:
+            return keys or None
+        text += key_decoder.decode(data)
+        if select.select([fd], [], [], 0)[0]:
+            continue
+        i = 0
+        while i < len(text):
+            c = text[i]
+            if c != '\x1b':
+                if not in_paste or c >= ' ' and c != '\x7f':
+                    keys.append(c)
+                i += 1
+                continue
+            end = escape_end(text, i)
+            if end is None:
+                break
+            seq = text[i:end]
+            i = end
+            if seq == '\x1b[200~':
+                in_paste = True
+            elif seq == '\x1b[201~':
+                in_paste = False
+            elif not in_paste:
+                keys.append(seq)
+        text = text[i:]
+        # A cut-off sequence gets a moment to complete; a lone ESC is dropped
+        if not text or not select.select([fd], [], [], 0.05)[0]:
+            return keys
+
+class Entry:
+    # one directory entry as seen by scandir; symlinks are described by their target
+    __slots__ = ('name', 'is_dir', 'size', 'mtime')
+
+    def __init__(self, name, is_dir, size, mtime):
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+
+    def label(self):
+        return self.name + '/' if self.is_dir else self.name
+
+class ListingCache:
+    # sorted listings keyed by path, valid while the directory's mtime and inode are unchanged
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, root):
+        st = os.stat(root)
+        key = (st.st_mtime_ns, st.st_ino)
+        entry = self.entries.get(root)
+        if entry is not None and entry[0] == key:
+            self.entries.move_to_end(root)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        records = {}
+        with os.scandir(root) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    records[entry.name] = Entry(entry.name, True, st.st_size, st.st_mtime)
+                elif stat.S_ISREG(st.st_mode):
+                    records[entry.name] = Entry(entry.name, False, st.st_size, st.st_mtime)
+        pathlist = sorted(records)
+        self.entries[root] = (key, pathlist, records)
+        self.entries.move_to_end(root)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return pathlist
+
+    def records(self, root):
+        # records of the listing last returned for root, without revalidating
+        entry = self.entries.get(root)
+        return entry[2] if entry is not None else {}
+
+    def lookup(self, path):
+        # the record for path from its parent's listing, or None if it is neither file nor directory
+        root, name = os.path.split(os.path.normpath(path))
+        try:
+            self.get(root)
+        except OSError:
+            return None
+        return self.records(root).get(name)
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total else 0
+        return f"Listing cache: {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), {len(self.entries)}/{self.size} entries"
+
+listing_cache = ListingCache(listing_cache_size)
+
 def getdirs(root):
-    pathlist = []
+    # the returned list is shared with the cache and must not be modified
     try:
-        paths = os.listdir(root)
-        for path in paths:
-            full_path = os.path.join(root, path)
-            if os.path.isdir(full_path) or os.path.isfile(full_path):
-                pathlist.append(path)
+        pathlist = listing_cache.get(root)
     except OSError as e:
         sys.stderr.write(f"Error accessing directory: {e}\n\r")
         pathlist = ["ERROR%"]
     return pathlist
 
-def get_all_dirs(root_dir):
-    directories = []
-    if os.access(root_dir, os.R_OK):
-        try:
-            for entry in os.scandir(root_dir):
+def get_entry(path):
+    return listing_cache.lookup(path)
+
+def dirs_first(root):
+    records = listing_cache.records(root)
+    return sorted(records.values(), key=lambda e: (not e.is_dir, e.name))
+
+def scan_dir(path):
+    children = []
+    try:
+        mtime = os.stat(path, follow_symlinks=False).st_mtime_ns
+        with os.scandir(path) as it:
+            for entry in it:
                 if entry.is_dir(follow_symlinks=False):
-                    directories.append(entry.path)
-                    directories.extend(get_all_dirs(entry.path))  # Recursively add subdirectories
-        except PermissionError:
-            pass
-        except Exception as e:
-            pass
-    else:
-        pass
-    return directories
-  
+                    children.append(entry.path)
+    except OSError:
+        return None, children
+    return mtime, children
+
+def walk_dirs(roots, on_dir, threads=None):
+    # Iterative walk: every worker owns a deque it consumes FIFO (so shallow
+    # dirs come first) and steals from the back of the others when it runs dry
+    threads = threads or walker_threads
+    queues = [deque() for _ in range(threads)]
+    for i, root in enumerate(roots):
+        queues[i % threads].append(root)
+    cond = threading.Condition()
+    outstanding = [len(roots)]
+
+    def steal(me):
+        for q in queues:
+            if q is not me:
+                try:
+                    return q.pop()
+                except IndexError:
+                    pass
+        return None
+
+    def worker(q):
+        while True:
+            try:
+                path = q.popleft()
+            except IndexError:
+                path = steal(q)
+                if path is None:
+                    with cond:
+                        if outstanding[0] == 0:
+                            cond.notify_all()
+                            return
+                        cond.wait(0.01)
+                    continue
+            mtime, children = scan_dir(path)
+            on_dir(path, mtime, children)
+            # Counted before they are published, so a worker that steals and
+            # finishes a child can't see zero outstanding and quit early
+            with cond:
+                outstanding[0] += len(children) - 1
+                q.extend(children)
+                if children:
+                    cond.notify(len(children))
+
+    if threads == 1:
+        worker(queues[0])
+        return
+    workers = [threading.Thread(target=worker, args=(q,), daemon=True) for q in queues]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+def save_index(pending):
+    # Snapshot layout: header line, the parent ids (int32, -1 for a root) and
+    # mtimes (int64) of every node as raw arrays, numbered breadth-first so
+    # parents come before children, then NUL terminated names, then the crawl
+    # frontier (unscanned dirs)
+    os.makedirs(data_dir, exist_ok=True)
+    order = list(node_roots.values())
+    renum = {-1: -1}
+    i = 0
+    while i < len(order):
+        n = order[i]
+        renum[n] = i
+        c = node_child[n]
+        while c >= 0:
+            order.append(c)
+            c = node_next[c]
+        i += 1
+    tmppath = index_file + '.tmp'
+    with open(tmppath, 'wb') as f:
+        complete = 0 if pending else 1
+        f.write(f"JOEMAMA-INDEX 2 {complete} {len(order)} {len(pending)}\n".encode())
+        f.write(array('i', [renum[node_parent[n]] for n in order]).tobytes())
+        f.write(array('q', [node_mtime[n] for n in order]).tobytes())
+        for n in order:
+            f.write(os.fsencode(node_names[node_name[n]]) + b'\0')
+        for p in pending:
+            f.write(os.fsencode(p) + b'\0')
+    os.replace(tmppath, index_file)
+
+def load_index():
+    try:
+        with open(index_file, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    with buf:
+        end = buf.find(b'\n')
+        header = buf[:end].split()
+        if len(header) != 5 or header[:2] != [b'JOEMAMA-INDEX', b'2']:
+            return None
+        try:
+            count, npending = int(header[3]), int(header[4])
+        except ValueError:
+            return None
+        start = end + 1 + 12 * count
+        if count < 0 or npending < 0 or len(buf) < start:
+            return None
+        parents = array('i', buf[end + 1:end + 1 + 4 * count])
+        mtimes = array('q', buf[end + 1 + 4 * count:start])
+        records = buf[start:].split(b'\0')
+        if len(records) < count + npending:
+            return None
+    names = array('i', [intern_name(os.fsdecode(name)) for name in records[:count]])
+    # Breadth-first numbering keeps each dir's children contiguous, so the
+    # sibling links can be filled in bulk
+    nexts = array('i', [n + 1 if n + 1 < count and parents[n + 1] == p >= 0 else -1 for n, p in enumerate(parents)])
+    prevs = array('i', [n - 1 if n and parents[n - 1] == p >= 0 else -1 for n, p in enumerate(parents)])
+    children = array('i', [-1]) * count
+    depths = array('H')
+    for n, p in enumerate(parents):
+        if p >= 0:
+            depths.append(depths[p] + 1)
+            if prevs[n] < 0:
+                children[p] = n
+        else:
+            depths.append(0)
+    node_parent.extend(parents)
+    node_name.extend(names)
+    node_depth.extend(depths)
+    node_child.extend(children)
+    node_next.extend(nexts)
+    node_prev.extend(prevs)
+    node_mtime.extend(mtimes)
+    for n, p in enumerate(parents):
+        if p < 0:
+            node_roots[node_path(n)] = n
+    return [os.fsdecode(p) for p in records[count:count + npending]]
+
+def crawl_index(roots):
+    # crawl_pending maps each frontier path to its node when known (-1 when
+    # not), which spares a lookup from the root for every crawled dir
+    last_save = [time.monotonic()]
+
+    def on_dir(path, mtime, children):
+        with index_lock:
+            n = crawl_pending.pop(path, -1)
+            if n < 0 or node_name[n] < 0:
+                if mtime is None:
+                    return
+                n = add_path(path)
+            if mtime is not None:
+                node_mtime[n] = mtime
+            fresh = []
+            for c in children:
+                name = c.rpartition('/')[2]
+                m = child_node(n, name)
+                crawl_pending[c] = m if m >= 0 else new_node(n, name, fresh=fresh)
+            add_leaves(fresh)
+            crawl_status['scanned'] += 1
+            if time.monotonic() - last_save[0] > index_checkpoint_secs:
+                save_index(crawl_pending)
+                last_save[0] = time.monotonic()
+        watch_dir(path, n)
+
+    with index_lock:
+        for r in roots:
+            crawl_pending.setdefault(r, -1)
+    if roots:
+        walk_dirs(list(roots), on_dir)
+
+def crawl_later(paths):
+    if paths:
+        threading.Thread(target=crawl_index, args=(paths,), daemon=True).start()
+
+def drop_subtrees(roots):
+    for p in roots:
+        n = find_node(p)
+        if n >= 0:
+            drop_node(n)
+
+def revalidate_index():
+    # Depth-first over the tree: only dirs whose mtime moved since the
+    # snapshot get listed again; new children are queued on the crawl
+    # frontier, gone ones are dropped with their subtrees. Dirs already on
+    # the frontier are only checked for existence, the crawl lists them. A
+    # stacked path is rebuilt from its node if a subtree move happened since
+    # it was pushed
+    with index_lock:
+        stack = [(n, root, node_moves) for root, n in node_roots.items()]
+    while stack:
+        n, path, moves = stack.pop()
+        with index_lock:
+            if node_name[n] < 0:
+                continue
+            if moves != node_moves:
+                path = node_path(n)
+                moves = node_moves
+            frontier = path in crawl_pending
+            known = {}
+            c = node_child[n]
+            while c >= 0:
+                known[node_names[node_name[c]]] = c
+                c = node_next[c]
+        watch_dir(path, n)
+        try:
+            mtime = os.stat(path, follow_symlinks=False).st_mtime_ns
+        except OSError:
+            with index_lock:
+                if node_name[n] >= 0 and moves == node_moves:
+                    drop_node(n)
+                elif node_name[n] >= 0:
+                    stack.append((n, path, moves))
+            continue
+        if mtime != node_mtime[n] and not frontier:
+            found = set()
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            found.add(entry.name)
+            except OSError:
+                found = None
+            if found is not None:
+                with index_lock:
+                    if moves != node_moves:
+                        stack.append((n, path, moves))
+                        continue
+                    for name in known.keys() - found:
+                        if node_name[known[name]] >= 0:
+                            drop_node(known.pop(name))
+                    fresh = []
+                    for name in found - known.keys():
+                        if child_node(n, name) < 0:
+                            crawl_pending[os.path.join(path, name)] = new_node(n, name, fresh=fresh)
+                    add_leaves(fresh)
+                    node_mtime[n] = mtime
+        stack.extend((c, os.path.join(path, name), moves) for name, c in known.items())
+
+def index_worker(revalidate):
+    crawl_status['started'] = time.monotonic()
+    crawl_status['running'] = True
+    try:
+        start_watcher()
+        build_leaf_search()
+        if revalidate:
+            revalidate_index()
+        crawl_index(list(crawl_pending))
+        with index_lock:
+            save_index(crawl_pending)
+        # The index is millions of long-lived objects; keep them out of the
+        # collector's full passes, which otherwise stall every keystroke
+        gc.freeze()
+    finally:
+        crawl_status['running'] = False
+
+def start_watcher():
+    global inotify_fd, libc
+    if not sys.platform.startswith('linux') or inotify_fd is not None:
+        return
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return
+    if fd < 0:
+        return
+    inotify_fd = fd
+    threading.Thread(target=read_inotify, daemon=True).start()
+    threading.Thread(target=apply_inotify, daemon=True).start()
+
+def watch_dir(path, node):
+    global watches_full
+    if inotify_fd is None or watches_full or node in watched:
+        return
+    wd = libc.inotify_add_watch(inotify_fd, os.fsencode(path), IN_WATCH_MASK)
+    if wd < 0:
+        # ENOSPC means max_user_watches is used up; dirs past that point are
+        # only picked up by the next mtime revalidation
+        if ctypes.get_errno() == errno.ENOSPC:
+            watches_full = True
+        return
+    with index_lock:
+        if node_name[node] < 0:
+            libc.inotify_rm_watch(inotify_fd, wd)
+            return
+        watched[node] = wd
+        watch_paths[wd] = node
+
+def read_inotify():
+    global inotify_overflow
+    while True:
+        select.select([inotify_fd], [], [])
+        try:
+            buf = os.read(inotify_fd, 65536)
+        except BlockingIOError:
+            continue
+        off = 0
+        while off < len(buf):
+            wd, mask, cookie, length = struct.unpack_from('iIII', buf, off)
+            name = buf[off + 16:off + 16 + length].rstrip(b'\0')
+            off += 16 + length
+            try:
+                inotify_events.put_nowait((wd, mask, name))
+            except queue.Full:
+                inotify_overflow = True
+
+def apply_inotify():
+    global inotify_overflow
+    while True:
+        wd, mask, name = inotify_events.get()
+        if inotify_overflow or mask & IN_Q_OVERFLOW:
+            # Events were lost, so fall back to an mtime rescan of the index
+            while not inotify_events.empty():
+                inotify_events.get_nowait()
+            inotify_overflow = False
+            revalidate_index()
+            crawl_index(list(crawl_pending))
+            continue
+        if mask & IN_IGNORED:
+            with index_lock:
+                node = watch_paths.pop(wd, None)
+                if node is not None and watched.get(node) == wd:
+                    del watched[node]
+            continue
+        if not mask & IN_ISDIR:
+            continue
+        name = os.fsdecode(name)
+        with index_lock:
+            parent = watch_paths.get(wd)
+            if parent is None or node_name[parent] < 0:
+                continue
+            n = child_node(parent, name)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # A node that is already there may have been added by one of
+                # our own commands before this event arrived; unless it is
+                # watched or about to be crawled, it is crawled so it gets
+                # its watch
+                if n >= 0:
+                    path = node_path(n)
+                    if n in watched or path in crawl_pending:
+                        continue
+                else:
+                    n = new_node(parent, name)
+                    path = node_path(n)
+                crawl_pending[path] = n
+            else:
+                if n >= 0:
+                    drop_node(n)
+                continue
+        crawl_index([path])
+
+def crawl_rate():
+    elapsed = time.monotonic() - crawl_status['started']
+    return int(crawl_status['scanned'] / elapsed) if elapsed > 0 else 0
+
+def build_index(root):
+    # Loads the snapshot (or seeds an empty index) and hands revalidation and
+    # crawling to a background thread so the prompt comes up immediately
+    pending = load_index()
+    # A snapshot is revalidated even when it has a crawl frontier left over,
+    # since the part already scanned may have changed as well
+    revalidate = pending is not None
+    if pending is None:
+        for a in (node_parent, node_name, node_depth, node_child, node_next, node_prev, node_mtime):
+            del a[:]
+        node_roots.clear()
+        make_node(-1, root.rstrip('/'))
+        pending = [root]
+    crawl_pending.update(dict.fromkeys(pending, -1))
+    update_leaves()
+    threading.Thread(target=index_worker, args=(revalidate,), daemon=True).start()
+
 
 def update_path(currpath):
     global vars
@@ -285,6 +1871,98 @@ def update_path(currpath):
     vars['$CURRDIR'] = currpath
     return pathlist
 
+def open_frecency():
+    global frecency_db, frecency_last_flush
+    os.makedirs(data_dir, exist_ok=True)
+    try:
+        frecency_db = sqlite3.connect(frecency_file, check_same_thread=False)
+        frecency_db.execute('PRAGMA journal_mode=WAL')
+        frecency_db.execute('CREATE TABLE IF NOT EXISTS visits (path TEXT PRIMARY KEY, count INTEGER, last REAL)')
+        for path, count, last in frecency_db.execute('SELECT path, count, last FROM visits'):
+            frecency[path] = [count, last]
+    except sqlite3.Error as e:
+        sys.stderr.write(f"Frecency store unavailable: {e}\n\r")
+        frecency_db = None
+    frecency_last_flush = time.monotonic()
+
+def flush_frecency():
+    global frecency_last_flush
+    frecency_last_flush = time.monotonic()
+    if frecency_db is None or not frecency_pending:
+        return
+    rows = [(p, c, last) for p, (c, last) in frecency_pending.items()]
+    frecency_pending.clear()
+    try:
+        with frecency_db:
+            frecency_db.executemany(
+                'INSERT INTO visits (path, count, last) VALUES (?, ?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET count = count + excluded.count, '
+                'last = max(last, excluded.last)', rows)
+    except sqlite3.Error as e:
+        sys.stderr.write(f"Couldn't save frecency: {e}\n\r")
+
+def record_visit(path):
+    # Kept in memory right away; written to SQLite in batches
+    global frecency_version
+    now = time.time()
+    entry = frecency.setdefault(path, [0, now])
+    entry[0] += 1
+    entry[1] = now
+    pending = frecency_pending.setdefault(path, [0, now])
+    pending[0] += 1
+    pending[1] = now
+    frecency_version += 1
+    if len(frecency_pending) >= frecency_batch or time.monotonic() - frecency_last_flush > frecency_flush_secs:
+        flush_frecency()
+
+def frecency_score(path):
+    entry = frecency.get(path)
+    if entry is None:
+        return 0.0
+    count, last = entry
+    return count * 0.5 ** ((time.time() - last) / frecency_half_life)
+
+def child_scores(currpath, pathlist):
+    names = set(pathlist)
+    scores = {}
+    for path in frecency:
+        parent, _, name = path.rpartition('/')
+        if parent == currpath and name in names:
+            scores[name] = frecency_score(path)
+    return scores
+
+def leaf_scores():
+    # Best score per indexed leaf, recomputed only after a new visit
+    global leaf_scores_cache, leaf_scores_version
+    if leaf_scores_version != frecency_version:
+        scores = {}
+        for path in frecency:
+            if is_indexed(path):
+                leaf = get_leaf(path)
+                scores[leaf] = max(scores.get(leaf, 0.0), frecency_score(path))
+        leaf_scores_version = frecency_version
+        leaf_scores_cache = scores
+    return leaf_scores_cache
+
+def frecency_rank(query, found, scores, k=10):
+    # Visited names matching the query go first within their group (prefix
+    # hits, then the rest), most frecent first
+    hot = sorted((n for n in scores if query in n), key=lambda n: -scores[n])
+    if not hot:
+        return found
+    hotset = set(hot)
+    prefix = [n for n in hot if n.startswith(query)]
+    prefix += [n for n in found if n.startswith(query) and n not in hotset]
+    others = [n for n in hot if not n.startswith(query)]
+    others += [n for n in found if not n.startswith(query) and n not in hotset]
+    return (prefix + others)[:k]
+
+def pick_frecent(paths):
+    scores = sorted(((frecency_score(p), p) for p in paths), reverse=True)
+    if scores[0][0] > 0 and scores[0][0] > scores[1][0]:
+        return scores[0][1]
+    return None
+
 def hide_cursor():
     sys.stdout.write('\033[?25l')
     sys.stdout.flush()
@@ -326,13 +2004,931 @@ def run_script_in_new_terminal(command):
     sys.stdout.write('\n'+''.join([p if p!= '\n' else '\n\r' for p in pipeout]) + '\n\r')
     sys.stdout.flush()
 
+class ShellProcess:
+    # Popen-like handle on a forked shell; the lock keeps a blocking wait()
+    # in the pump thread and a poll() from kill() from both reaping it
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+        self.lock = threading.Lock()
+
+    def poll(self):
+        if self.returncode is None and self.lock.acquire(blocking=False):
+            try:
+                self.reap(os.WNOHANG)
+            finally:
+                self.lock.release()
+        return self.returncode
+
+    def wait(self):
+        with self.lock:
+            self.reap(0)
+        return self.returncode
+
+    def reap(self, flags):
+        if self.returncode is not None:
+            return
+        pid, status = os.waitpid(self.pid, flags)
+        if pid:
+            self.returncode = os.waitstatus_to_exitcode(status)
+
+def spawn_shell(command, slave):
+    # Plain fork rather than Popen(preexec_fn=...), which is not safe with
+    # the crawler and job threads running. The child becomes a session
+    # leader with the pty as its controlling terminal, so Job.kill can
+    # signal its whole group
+    argv = [os.environ.get('SHELL', '/bin/sh'), '-c', command]
+    with warnings.catch_warnings():
+        # 3.12+ warns about forking with threads; the child only execs
+        warnings.simplefilter('ignore', DeprecationWarning)
+        pid = os.fork()
+    if pid == 0:
+        try:
+            os.setsid()
+            fcntl.ioctl(slave, termios.TIOCSCTTY, 0)
+            for fd in (0, 1, 2):
+                os.dup2(slave, fd)
+            if slave > 2:
+                os.close(slave)
+            # Python ignores these at startup and SIG_IGN survives exec
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+            signal.signal(signal.SIGXFSZ, signal.SIG_DFL)
+            os.execvp(argv[0], argv)
+        finally:
+            os._exit(127)
+    return ShellProcess(pid)
+
+# The warm worker is a separate interpreter that imports the preload list
+# once and then forks for every script. Each run gets a supervisor fork that
+# takes the pty as its session's terminal and forks the script itself, so a
+# script can be signalled as a process group while the supervisor survives
+# to report how it ended
+warm_server_code = r'''
+import os, sys, socket, json, struct, signal, fcntl, termios, runpy, traceback
+ctrl = socket.socket(fileno=int(sys.argv[1]))
+for name in sys.argv[2:]:
+    try:
+        __import__(name)
+    except Exception:
+        pass
+signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+def report(e, path):
+    # Tracebacks start at the script, as they would under a fresh python3
+    tb = e.__traceback__
+    while tb is not None and tb.tb_frame.f_code.co_filename != path:
+        tb = tb.tb_next
+    traceback.print_exception(type(e), e, tb or e.__traceback__)
+def run(req, slave, status):
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    os.setsid()
+    fcntl.ioctl(slave, termios.TIOCSCTTY, 0)
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT):
+        signal.signal(sig, signal.SIG_IGN)
+    status.sendall(struct.pack('i', os.getpid()))
+    pid = os.fork()
+    if pid:
+        os.close(slave)
+        status.sendall(struct.pack('i', os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])))
+        return
+    status.close()
+    for sig in (signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT):
+        signal.signal(sig, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    for fd in (0, 1, 2):
+        os.dup2(slave, fd)
+    os.close(slave)
+    sys.stdin = sys.__stdin__ = open(0, 'r', closefd=False)
+    sys.stdout = sys.__stdout__ = open(1, 'w', buffering=1, closefd=False)
+    sys.stderr = sys.__stderr__ = open(2, 'w', buffering=1, closefd=False, errors='backslashreplace')
+    os.chdir(req['cwd'])
+    sys.argv = req['argv']
+    sys.path[0] = os.path.dirname(req['argv'][0])
+    code = 0
+    try:
+        runpy.run_path(req['argv'][0], run_name='__main__')
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except KeyboardInterrupt as e:
+        report(e, req['argv'][0])
+        sys.stderr.flush()
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGINT)
+    except BaseException as e:
+        report(e, req['argv'][0])
+        code = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code & 0xff)
+while True:
+    try:
+        msg, fds, _, _ = socket.recv_fds(ctrl, 1 << 16, 2)
+    except OSError:
+        break
+    if not msg:
+        break
+    slave, status = fds
+    if os.fork() == 0:
+        ctrl.close()
+        try:
+            run(json.loads(msg), slave, socket.socket(fileno=status))
+        finally:
+            os._exit(0)
+    os.close(slave)
+    os.close(status)
+'''
+
+class WarmProcess:
+    # Popen-like handle on a script run by the warm worker: its supervisor
+    # sends its pid (the process group to signal), then the exit status
+    def __init__(self, sock):
+        self.sock = sock
+        self.returncode = None
+        data = b''
+        while len(data) < 4:
+            chunk = sock.recv(4 - len(data))
+            if not chunk:
+                raise OSError('warm worker went away')
+            data += chunk
+        self.pid = struct.unpack('i', data)[0]
+
+    def poll(self):
+        if self.returncode is None and select.select([self.sock], [], [], 0)[0]:
+            self.collect()
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self.collect()
+        return self.returncode
+
+    def collect(self):
+        data = self.sock.recv(4)
+        # No status means the supervisor was killed along with the script
+        self.returncode = struct.unpack('i', data)[0] if len(data) == 4 else -signal.SIGKILL
+        self.sock.close()
+
+def start_warm_server():
+    # Callers hold warm_lock
+    global warm_server
+    stop_warm_server()
+    ours, theirs = socket.socketpair()
+    proc = subprocess.Popen([file_runners['.py'], '-c', warm_server_code, str(theirs.fileno())] + warm_modules,
+                            pass_fds=[theirs.fileno()], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL, start_new_session=True)
+    theirs.close()
+    warm_server = (proc, ours)
+
+def stop_warm_server():
+    # Closing the control socket ends the worker; runs in flight finish
+    global warm_server
+    if warm_server is not None:
+        warm_server[1].close()
+        warm_server[0].wait()
+        warm_server = None
+
+def spawn_warm(path, slave):
+    payload = json.dumps({'argv': [path], 'cwd': os.getcwd()}).encode()
+    with warm_lock:
+        for attempt in (0, 1):
+            if warm_server is None or warm_server[0].poll() is not None:
+                start_warm_server()
+            ours, theirs = socket.socketpair()
+            try:
+                socket.send_fds(warm_server[1], [payload], [slave, theirs.fileno()])
+                break
+            except OSError:
+                ours.close()
+                if attempt:
+                    raise
+                start_warm_server()
+            finally:
+                theirs.close()
+    return WarmProcess(ours)
+
+class Job:
+    # One ::cmd or ::run command under its own pty. A reader thread keeps the
+    # last job_output_bytes of its output and, while the job is in the
+    # foreground, copies it to our terminal as it arrives
+    def __init__(self, command, spawn=spawn_shell):
+        self.id = next(job_ids)
+        self.command = command
+        self.spawn = spawn
+        self.proc = None
+        self.master = None
+        self.lock = threading.Lock()
+        self.output = deque()
+        self.size = 0
+        self.dropped = 0
+        self.attached = False
+        self.reported = False
+        self.termed = False
+        self.started = None
+        self.ended = None
+        self.code = None
+        self.error = None
+        self.done = threading.Event()
+
+    def start(self):
+        master, slave = os.openpty()
+        try:
+            fcntl.ioctl(slave, termios.TIOCSWINSZ, fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, b'\0' * 8))
+        except OSError:
+            pass
+        self.started = time.perf_counter()
+        try:
+            self.proc = self.spawn(self.command, slave)
+        except OSError as e:
+            os.close(master)
+            os.close(slave)
+            self.error = str(e)
+            self.finish()
+            return
+        os.close(slave)
+        self.master = master
+        threading.Thread(target=self.pump, daemon=True).start()
+
+    def pump(self):
+        while True:
+            ready = select.select([self.master], [], [], 0.1)[0]
+            if ready:
+                try:
+                    data = os.read(self.master, 65536)
+                except OSError:
+                    data = b''
+                if not data:
+                    break
+                with self.lock:
+                    self.keep(data)
+                    if self.attached:
+                        os.write(sys.stdout.fileno(), data)
+            elif self.proc.poll() is not None:
+                # Exited, but something it left behind may still hold the pty
+                break
+        with self.lock:
+            os.close(self.master)
+            self.master = None
+        self.code = self.proc.wait()
+        self.finish()
+        with jobs_lock:
+            start_jobs()
+
+    def keep(self, data):
+        self.output.append(data)
+        self.size += len(data)
+        while self.size > job_output_bytes:
+            excess = self.size - job_output_bytes
+            first = self.output[0]
+            if len(first) <= excess:
+                self.output.popleft()
+                cut = len(first)
+            else:
+                self.output[0] = first[excess:]
+                cut = excess
+            self.size -= cut
+            self.dropped += cut
+
+    def finish(self):
+        self.ended = time.perf_counter()
+        self.done.set()
+        if not self.attached:
+            job_events.append(self)
+            os.write(job_wakeup[1], b'.')
+
+    def send(self, data):
+        with self.lock:
+            if self.master is not None:
+                os.write(self.master, data)
+
+    def kill(self):
+        # SIGTERM first, SIGKILL if it is asked to die again
+        if self.proc is None:
+            if not self.done.is_set():
+                self.error = 'cancelled'
+                self.finish()
+            return
+        if self.proc.poll() is None:
+            sig = signal.SIGKILL if self.termed else signal.SIGTERM
+            self.termed = True
+            try:
+                os.killpg(self.proc.pid, sig)
+            except OSError:
+                pass
+
+    def status(self):
+        if self.error is not None:
+            return self.error
+        if self.proc is None:
+            return 'queued'
+        if not self.done.is_set():
+            return 'running'
+        if self.code < 0:
+            return f'killed by {signal.Signals(-self.code).name}'
+        return f'exit {self.code}'
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.ended or time.perf_counter()) - self.started
+
+def start_jobs():
+    # Callers hold jobs_lock. Queued jobs start in order while under the limit
+    running = running_jobs()
+    for job in jobs.values():
+        if running >= job_limit:
+            break
+        if job.proc is None and job.error is None:
+            job.start()
+            if job.error is None:
+                running += 1
+    finished = [i for i, j in jobs.items() if j.done.is_set()]
+    for i in finished[:max(len(finished) - job_keep, 0)]:
+        del jobs[i]
+
+def running_jobs():
+    return sum(1 for j in jobs.values() if j.proc is not None and not j.done.is_set())
+
+def submit_job(command, spawn=spawn_shell):
+    job = Job(command, spawn)
+    with jobs_lock:
+        jobs[job.id] = job
+        start_jobs()
+    return job
+
+def fg_job(job):
+    # Replays what the job has printed so far, then streams it live and feeds
+    # it our keys until it ends. Ctrl-Z leaves it running in the background
+    fd = sys.stdin.fileno()
+    sys.stdout.flush()
+    with job.lock:
+        if job.dropped:
+            os.write(sys.stdout.fileno(), f'[{job.dropped} earlier bytes dropped]\r\n'.encode())
+        for chunk in job.output:
+            os.write(sys.stdout.fileno(), chunk)
+        job.attached = True
+    try:
+        while not job.done.is_set():
+            if not select.select([fd], [], [], 0.1)[0]:
+                continue
+            data = os.read(fd, 4096)
+            if b'\x1a' in data:
+                sys.stdout.write(f"\n\r[{job.id}] {job.status()} in the background: {job.command}\n\r")
+                sys.stdout.flush()
+                return
+            if job.proc is None and b'\x03' in data:
+                job.kill()
+            job.send(data)
+    finally:
+        job.attached = False
+    job.reported = True
+    sys.stdout.write(f"\n\r[{job.status()}, {job.elapsed():.2f}s]\n\r")
+    sys.stdout.flush()
+
+def find_job(arg):
+    # A job by id, or the newest unfinished one when no id is given
+    with jobs_lock:
+        if arg == '':
+            live = [j for j in jobs.values() if not j.done.is_set()]
+            return live[-1] if live else None
+        try:
+            return jobs.get(int(arg))
+        except ValueError:
+            return None
+
+def list_jobs():
+    with jobs_lock:
+        rows = [f"[{j.id}] {j.status():<18} {j.elapsed():8.1f}s  {j.command}" for j in jobs.values()]
+        running = running_jobs()
+    rows.append(f"{running} running, limit {job_limit}")
+    sys.stdout.write('\n\r'.join(rows) + '\n\r')
+    sys.stdout.flush()
+
+def show_job_output(job):
+    sys.stdout.flush()
+    with job.lock:
+        if job.dropped:
+            os.write(sys.stdout.fileno(), f'[{job.dropped} earlier bytes dropped]\r\n'.encode())
+        for chunk in job.output:
+            os.write(sys.stdout.fileno(), chunk)
+    sys.stdout.write(f"\n\r[{job.id}] {job.status()}, {job.elapsed():.2f}s\n\r")
+    sys.stdout.flush()
+
+def job_notices():
+    # Jobs that finished in the background, reported above the prompt
+    os.read(job_wakeup[0], 4096)
+    while job_events:
+        job = job_events.popleft()
+        if not job.reported:
+            job.reported = True
+            renderer.notice(f"[{job.id}] {job.status()} after {job.elapsed():.2f}s: {job.command}")
+
+def build_key(source, compiler):
+    # Source content plus the compiler command line, and the compiler
+    # binary's identity so an upgrade rebuilds
+    h = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    h.update(b'\0' + compiler.encode())
+    binary = shutil.which(shlex.split(compiler)[0])
+    if binary:
+        st = os.stat(binary)
+        h.update(f'\0{os.path.realpath(binary)}\0{st.st_size}\0{st.st_mtime_ns}'.encode())
+    return h.hexdigest()
+
+def compile_cached(source, compiler):
+    # Binaries live in the build cache under their key. A hit only bumps the
+    # mtime the LRU goes by; a miss compiles to a private temp file that is
+    # renamed into place, so concurrent builds and runs never see a partial
+    # binary. Returns the binary's path, None if compilation failed
+    os.makedirs(build_cache_dir, exist_ok=True)
+    exe = os.path.join(build_cache_dir, build_key(source, compiler))
+    try:
+        os.utime(exe)
+        return exe
+    except FileNotFoundError:
+        pass
+    fd, tmppath = tempfile.mkstemp(dir=build_cache_dir, prefix='.build-')
+    os.close(fd)
+    start = time.perf_counter()
+    try:
+        result = subprocess.run(shlex.split(compiler) + ['-o', tmppath, source],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    except OSError as e:
+        os.remove(tmppath)
+        sys.stdout.write(f"Couldn't compile: {e}\n\r")
+        sys.stdout.flush()
+        return None
+    if result.stdout:
+        sys.stdout.write(result.stdout.replace('\n', '\n\r'))
+    if result.returncode != 0:
+        os.remove(tmppath)
+        sys.stdout.write(f"Compilation failed with exit {result.returncode}\n\r")
+        sys.stdout.flush()
+        return None
+    os.replace(tmppath, exe)
+    sys.stdout.write(f"Compiled {os.path.basename(source)} in {time.perf_counter() - start:.2f}s\n\r")
+    sys.stdout.flush()
+    trim_build_cache(exe)
+    return exe
+
+def trim_build_cache(keep):
+    # Least recently used binaries go first once the cache is over its budget
+    entries = []
+    total = 0
+    for e in os.scandir(build_cache_dir):
+        try:
+            st = e.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        if e.name.startswith('.build-') and time.time() - st.st_mtime < 3600:
+            continue
+        entries.append((st.st_mtime, e.path, st.st_size))
+        total += st.st_size
+    entries.sort()
+    for _, path, size in entries:
+        if total <= build_cache_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def script_runner(fullpath):
+    # The command that runs a script and how to spawn it, compiling first
+    # where needed; None once a failed build has been reported
+    file_extension = os.path.splitext(fullpath)[1]
+    runner = file_runners[file_extension]
+    if file_extension in ['.cpp', '.c', '.f90']:
+        exe = compile_cached(fullpath, runner)
+        if exe is None:
+            return None
+        return shlex.quote(exe), spawn_shell
+    command = f'{runner} {fullpath}'
+    if file_extension == '.py' and warm_python:
+        return command, lambda command, slave: spawn_warm(fullpath, slave)
+    return command, spawn_shell
+
+def open_file_watch(paths):
+    # A private inotify instance on the files' directories, since editors
+    # often save by writing a new file and renaming it over the old one.
+    # Returns (fd, {wd: dir}), or None where inotify is unavailable
+    global libc
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        if libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    dirs = {}
+    for d in {os.path.dirname(p) for p in paths}:
+        wd = libc.inotify_add_watch(fd, os.fsencode(d), IN_SAVE_MASK)
+        if wd >= 0:
+            dirs[wd] = d
+    return fd, dirs
+
+def file_watch_changed(watch, paths):
+    # Drains the watch and says whether any event named one of paths
+    fd, dirs = watch
+    hit = False
+    while True:
+        try:
+            buf = os.read(fd, 65536)
+        except BlockingIOError:
+            return hit
+        off = 0
+        while off < len(buf):
+            wd, mask, cookie, length = struct.unpack_from('iIII', buf, off)
+            name = buf[off + 16:off + 16 + length].rstrip(b'\0')
+            off += 16 + length
+            if wd in dirs and os.path.join(dirs[wd], os.fsdecode(name)) in paths:
+                hit = True
+
+def file_stamps(paths):
+    stamps = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            stamps.append((st.st_mtime_ns, st.st_size, st.st_ino))
+        except OSError:
+            stamps.append(None)
+    return stamps
+
+def watch_script(fullpath, paths):
+    # Reruns fullpath whenever one of paths is saved, until Ctrl-C. Saves
+    # are debounced, and a save during a run cancels it in favour of a fresh
+    # one. Runs are foreground jobs outside the job limit. Without inotify
+    # the files' mtimes are polled instead
+    fd = sys.stdin.fileno()
+    paths = set(paths)
+    watch = open_file_watch(paths)
+    stamps = file_stamps(paths)
+    names = ', '.join(sorted(os.path.basename(p) for p in paths))
+    sys.stdout.write(f"Watching {names} {'with inotify' if watch else 'by polling'}, ctrl-c to stop\n\r")
+    sys.stdout.flush()
+    job = None
+    due = time.monotonic()
+    runs = 0
+    previous = None
+    try:
+        while True:
+            # Wake for the debounce deadline, to notice a run ending, and to poll
+            timeout = 0.1 if job is not None else None if watch else watch_poll_secs
+            if due is not None:
+                left = max(due - time.monotonic(), 0)
+                timeout = left if timeout is None else min(timeout, left)
+            ready = select.select([fd] + ([watch[0]] if watch else []), [], [], timeout)[0]
+            if fd in ready:
+                data = os.read(fd, 4096)
+                if b'\x03' in data:
+                    break
+                if job is not None:
+                    job.send(data)
+            if watch and watch[0] in ready:
+                if file_watch_changed(watch, paths):
+                    due = time.monotonic() + watch_debounce
+            elif watch is None:
+                fresh = file_stamps(paths)
+                if fresh != stamps:
+                    stamps = fresh
+                    due = time.monotonic() + watch_debounce
+            if job is not None and job.done.is_set():
+                delta = f" ({job.elapsed() - previous:+.2f}s)" if previous is not None else ''
+                sys.stdout.write(f"\n\r[run {runs}: {job.status()}, {job.elapsed():.2f}s{delta}]\n\r")
+                sys.stdout.flush()
+                previous = job.elapsed()
+                job = None
+            if due is not None and time.monotonic() >= due:
+                due = None
+                if job is not None:
+                    stop_job(job)
+                    sys.stdout.write(f"\n\r[run {runs}: cancelled after {job.elapsed():.2f}s by a newer change]\n\r")
+                    job = None
+                runner = script_runner(fullpath)
+                if runner is not None:
+                    runs += 1
+                    sys.stdout.write(f"[run {runs}: {datetime.now().strftime('%H:%M:%S')}]\n\r")
+                    sys.stdout.flush()
+                    job = Job(runner[0], runner[1])
+                    job.attached = True
+                    job.start()
+    finally:
+        if job is not None:
+            stop_job(job)
+        if watch:
+            os.close(watch[0])
+    sys.stdout.write(f"\n\rStopped watching after {runs} run{'s' if runs != 1 else ''}\n\r")
+    sys.stdout.flush()
+
+def stop_job(job):
+    # SIGTERM, then SIGKILL if it hasn't gone within half a second
+    job.kill()
+    if not job.done.wait(0.5):
+        job.kill()
+        job.done.wait(1)
+
+def run_command(command, background=False, spawn=spawn_shell):
+    # Background jobs always go through a pty, whichever runner is chosen
+    if runner_backend == 'terminal' and not background:
+        run_script_in_new_terminal(command)
+        return
+    job = submit_job(command, spawn)
+    if background:
+        sys.stdout.write(f"[{job.id}] {job.status()}: {command}\n\r")
+        sys.stdout.flush()
+    else:
+        fg_job(job)
+
+class CopyTask:
+    # One ::copyto. The walker recreates the directory tree and feeds files
+    # to a pool of workers; files over copy_chunk are split into ranges that
+    # are copied side by side. Data moves kernel-side where it can: a reflink
+    # clone, else copy_file_range, else sendfile, else pread/pwrite. Each
+    # fallback is remembered once it fails, so it is tried once per copy
+    def __init__(self, src, dest):
+        self.src = src
+        self.dest = dest
+        self.cancel = threading.Event()
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=copy_workers * 64)
+        self.files = 0
+        self.files_done = 0
+        self.bytes = 0
+        self.bytes_done = 0
+        self.walking = True
+        self.errors = []
+        self.ranges_left = {}
+        self.started = time.perf_counter()
+        self.ended = None
+        self.can_clone = sys.platform.startswith('linux')
+        self.can_range = hasattr(os, 'copy_file_range')
+        self.can_sendfile = sys.platform.startswith('linux')
+
+    def run(self):
+        workers = [threading.Thread(target=self.work, daemon=True) for _ in range(copy_workers)]
+        for w in workers:
+            w.start()
+        dirs = []
+        try:
+            self.walk(dirs)
+        except OSError as e:
+            self.error(e)
+        finally:
+            self.walking = False
+            for _ in workers:
+                self.queue.put(None)
+            for w in workers:
+                w.join()
+        # Files cut short by a cancel are not left looking complete
+        for dst, left in self.ranges_left.items():
+            if left:
+                try:
+                    os.remove(dst)
+                except OSError:
+                    pass
+        # Directory times go last, since filling a directory changes them
+        for dst, st in reversed(dirs):
+            try:
+                os.chmod(dst, stat.S_IMODE(st.st_mode))
+                os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+            except OSError as e:
+                self.error(e)
+        self.ended = time.perf_counter()
+
+    def walk(self, dirs):
+        # Symlinks are followed, as copy2 and copytree do by default
+        st = os.stat(self.src)
+        if not stat.S_ISDIR(st.st_mode):
+            # Opening the destination truncates it, so copying a file onto
+            # itself would empty it
+            try:
+                same = os.path.samestat(st, os.stat(self.dest))
+            except OSError:
+                same = False
+            if same:
+                raise shutil.SameFileError(f"'{self.src}' and '{self.dest}' are the same file")
+            self.add_file(self.src, self.dest, st)
+            return
+        stack = [(self.src, self.dest, st)]
+        while stack and not self.cancel.is_set():
+            src, dst, st = stack.pop()
+            try:
+                # Listed before the destination exists, so a destination
+                # inside the source is not copied into itself
+                with os.scandir(src) as it:
+                    entries = list(it)
+                if dst == self.dest:
+                    os.makedirs(dst)
+                else:
+                    os.mkdir(dst)
+                dirs.append((dst, st))
+            except OSError as e:
+                self.error(e)
+                continue
+            for e in entries:
+                if self.cancel.is_set():
+                    break
+                try:
+                    est = e.stat()
+                    if stat.S_ISDIR(est.st_mode):
+                        stack.append((e.path, os.path.join(dst, e.name), est))
+                    else:
+                        self.add_file(e.path, os.path.join(dst, e.name), est)
+                except OSError as err:
+                    self.error(err)
+
+    def add_file(self, src, dst, st):
+        if not stat.S_ISREG(st.st_mode):
+            raise OSError(errno.EINVAL, 'Not a regular file', src)
+        with self.lock:
+            self.files += 1
+            self.bytes += st.st_size
+        if st.st_size <= copy_chunk:
+            self.queue.put((src, dst, st, None, st.st_size))
+            return
+        # A large file is cloned outright if the filesystem can, otherwise
+        # sized up front and handed out in ranges
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                if self.clone(src_fd, dst_fd):
+                    self.finish_file(dst_fd, src_fd, st, st.st_size)
+                    return
+                os.ftruncate(dst_fd, st.st_size)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        offsets = range(0, st.st_size, copy_chunk)
+        with self.lock:
+            self.ranges_left[dst] = len(offsets)
+        for off in offsets:
+            self.queue.put((src, dst, st, off, min(copy_chunk, st.st_size - off)))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.cancel.is_set():
+                continue
+            src, dst, st, off, length = item
+            try:
+                self.copy(src, dst, st, off, length)
+            except OSError as e:
+                self.error(e)
+
+    def copy(self, src, dst, st, off, length):
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            if off is None:
+                dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            else:
+                dst_fd = os.open(dst, os.O_WRONLY)
+            try:
+                if off is None and self.clone(src_fd, dst_fd):
+                    self.finish_file(dst_fd, src_fd, st, length)
+                    return
+                done = self.copy_range(src_fd, dst_fd, off or 0, length)
+                if off is None:
+                    if done:
+                        self.finish_file(dst_fd, src_fd, st, 0)
+                    else:
+                        os.remove(dst)
+                    return
+                # A cancelled range leaves its count up, so run() removes the file
+                if not done:
+                    return
+                with self.lock:
+                    self.ranges_left[dst] -= 1
+                    last = self.ranges_left[dst] == 0
+                if last:
+                    self.finish_file(dst_fd, src_fd, st, 0)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+    def copy_range(self, src_fd, dst_fd, off, length):
+        # False if cancelled part way
+        end = off + length
+        while off < end:
+            if self.cancel.is_set():
+                return False
+            n = self.move(src_fd, dst_fd, off, min(end - off, copy_chunk // 8))
+            if n == 0:
+                break
+            off += n
+            with self.lock:
+                self.bytes_done += n
+        return True
+
+    def move(self, src_fd, dst_fd, off, count):
+        if self.can_range:
+            try:
+                return os.copy_file_range(src_fd, dst_fd, count, off, off)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                self.can_range = False
+        if self.can_sendfile:
+            try:
+                os.lseek(dst_fd, off, os.SEEK_SET)
+                return os.sendfile(dst_fd, src_fd, off, count)
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                self.can_sendfile = False
+        return os.pwrite(dst_fd, os.pread(src_fd, min(count, copy_block), off), off)
+
+    def clone(self, src_fd, dst_fd):
+        if not self.can_clone:
+            return False
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return True
+        except OSError:
+            self.can_clone = False
+            return False
+
+    def finish_file(self, dst_fd, src_fd, st, cloned):
+        # Mode, times and extended attributes, as copy2 carries them over
+        os.chmod(dst_fd, stat.S_IMODE(st.st_mode))
+        if hasattr(os, 'listxattr'):
+            try:
+                for name in os.listxattr(src_fd):
+                    try:
+                        os.setxattr(dst_fd, name, os.getxattr(src_fd, name))
+                    except OSError:
+                        pass
+            except OSError:
+                pass
+        os.utime(dst_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        with self.lock:
+            self.files_done += 1
+            self.bytes_done += cloned
+
+    def error(self, e):
+        with self.lock:
+            self.errors.append(str(e))
+
+    def rate(self):
+        elapsed = (self.ended or time.perf_counter()) - self.started
+        return self.bytes_done / max(elapsed, 1e-6) / 1e6, elapsed
+
+    def progress(self):
+        rate, _ = self.rate()
+        more = '+' if self.walking else ''
+        return (f"Copying {self.files_done:,}/{self.files:,}{more} files, "
+                f"{self.bytes_done / 1e6:,.1f}/{self.bytes / 1e6:,.1f}{more} MB, {rate:,.1f} MB/s (ctrl-c cancels)")
+
+    def summary(self):
+        rate, elapsed = self.rate()
+        if self.cancel.is_set():
+            text = f"Cancelled after {elapsed:.2f}s: {self.files_done:,} of {self.files:,}+ files copied, '{self.dest}' is incomplete"
+        else:
+            text = f"Copied {self.files_done:,} file{'s' if self.files_done != 1 else ''}, {self.bytes_done / 1e6:,.1f} MB in {elapsed:.2f}s ({rate:,.1f} MB/s)"
+        if self.errors:
+            text += f"\n\r{len(self.errors)} error{'s' if len(self.errors) != 1 else ''}, first: {self.errors[0]}"
+        return text
+
+def copy_paths(src, dest):
+    # Runs a CopyTask with a live progress line until it ends or Ctrl-C
+    # cancels it
+    task = CopyTask(src, dest)
+    worker = threading.Thread(target=task.run, daemon=True)
+    worker.start()
+    fd = sys.stdin.fileno()
+    while worker.is_alive():
+        if select.select([fd], [], [], 0.2)[0] and b'\x03' in os.read(fd, 1024):
+            task.cancel.set()
+        sys.stdout.write('\r' + task.progress()[:max(renderer.width - 1, 1)] + '\033[K')
+        sys.stdout.flush()
+    worker.join()
+    sys.stdout.write('\r' + task.summary() + '\033[K\n\r')
+    sys.stdout.flush()
+    return task
+
 def save_vars(key, val):
     global vars
     vars['$'+key] = val
     
 
 def tokenize_(tokens, currpath, cmdli):
-    global vars, pli, file_runners
+    global vars, file_runners, fuzzy, runner_backend, job_limit, warm_python, warm_modules
     if '::$' in tokens.strip() or tokens[0].strip() == '$':
         sys.stdout.write("Variables can only be used in command arguments\n\r")
         sys.stdout.flush()
@@ -352,11 +2948,23 @@ def tokenize_(tokens, currpath, cmdli):
         sys.stdout.write(currpath + '\n\r')
         sys.stdout.flush()
         return
+    if tokens.strip() == '::stats':
+        sys.stdout.write(listing_cache.stats() + '\n\r')
+        sys.stdout.flush()
+        return
     if tokens.strip() == '::clear':
         os.system('clear')
         return
+    if tokens.strip() == '::fuzzy':
+        fuzzy = not fuzzy
+        if fuzzy:
+            threading.Thread(target=build_fuzzy_index, daemon=True).start()
+        sys.stdout.write(f"Fuzzy matching {'on' if fuzzy else 'off'}\n\r")
+        sys.stdout.flush()
+        return
     if tokens.strip() == '::list':
-        sys.stdout.write('\n\r'.join(os.listdir(currpath)) + '\n\n\r')
+        getdirs(currpath)
+        sys.stdout.write('\n\r'.join(e.label() for e in dirs_first(currpath)) + '\n\n\r')
         sys.stdout.flush()
         return
     
@@ -395,8 +3003,82 @@ def tokenize_(tokens, currpath, cmdli):
             sys.stdout.write("Missing command arg\n\r")
             sys.stdout.flush()
             return
-        run_script_in_new_terminal(f'cd {currpath} && ' + cmdtokenli[1].strip())
+        command = cmdtokenli[1].strip()
+        # A trailing '&' (not '&&') starts the command as a background job
+        background = command.endswith('&') and not command.endswith('&&')
+        if background:
+            command = command[:-1].strip()
+        run_command(f'cd {currpath} && ' + command, background)
+        return
+
+    if cmdtokenli[0].strip() == 'runner':
+        backend = cmdtokenli[1].strip() if len(cmdtokenli) > 1 else ''
+        if backend not in ('pty', 'terminal'):
+            sys.stdout.write(f"Commands run with the {runner_backend} runner. Use `::runner >> pty` or `::runner >> terminal`\n\r")
+        else:
+            runner_backend = backend
+            sys.stdout.write(f"Commands now run with the {backend} runner\n\r")
+        sys.stdout.flush()
+        return
+
+    if cmdtokenli[0].strip() == 'warm':
+        if len(cmdtokenli) > 1:
+            warm_modules = [m.strip() for m in cmdtokenli[1].split(',') if m.strip()]
+            warm_python = True
+        else:
+            warm_python = not warm_python
+        with warm_lock:
+            if warm_python:
+                start_warm_server()
+            else:
+                stop_warm_server()
+        if warm_python:
+            sys.stdout.write(f"Python scripts run in a warm worker, preloading: {', '.join(warm_modules) or 'nothing'}\n\r")
+        else:
+            sys.stdout.write("Python scripts run in a fresh interpreter\n\r")
+        sys.stdout.flush()
+        return
+
+    if cmdtokenli[0].strip() == 'jobs':
+        if len(cmdtokenli) > 1:
+            try:
+                job_limit = max(1, int(cmdtokenli[1].strip()))
+            except ValueError:
+                sys.stdout.write("Job limit must be a number\n\r")
+                sys.stdout.flush()
+                return
+            with jobs_lock:
+                start_jobs()
+        list_jobs()
         return
+
+    if cmdtokenli[0].strip() in ('fg', 'kill', 'output'):
+        com = cmdtokenli[0].strip()
+        arg = cmdtokenli[1].strip() if len(cmdtokenli) > 1 else ''
+        job = find_job(arg)
+        if job is None:
+            sys.stdout.write(f"No job '{arg}'\n\r" if arg else "No running jobs\n\r")
+            sys.stdout.flush()
+        elif com == 'fg':
+            sys.stdout.write(f"[{job.id}] {job.command}\n\r")
+            fg_job(job)
+        elif com == 'kill':
+            job.kill()
+            sys.stdout.write(f"[{job.id}] {'killing' if job.status() == 'running' else job.status()}: {job.command}\n\r")
+            sys.stdout.flush()
+        else:
+            show_job_output(job)
+        return
+
+    background = False
+    if cmdtokenli[0].strip() == 'run' and len(cmdtokenli) > 1 and cmdtokenli[1].strip() == '&':
+        background = True
+        cmdtokenli = cmdtokenli[:1]
+
+    also_watch = []
+    if cmdtokenli[0].strip() == 'watch' and len(cmdtokenli) > 1:
+        also_watch = [os.path.normpath(os.path.join(currpath, f.strip())) for f in cmdtokenli[1].split(',') if f.strip()]
+        cmdtokenli = cmdtokenli[:1]
     
     if file_or_dir == '':
         sys.stdout.write("Missing file or dir name\n\r")
@@ -435,24 +3117,43 @@ def tokenize_(tokens, currpath, cmdli):
     if flag == 2:
         if com == 'rename' or com == 'moveto':
             try:
-                dircheck = os.path.isdir(fullpath)
-                shutil.move(fullpath, argpath)
+                entry = get_entry(fullpath)
+                dircheck = entry is not None and entry.is_dir
+                dest = os.path.normpath(shutil.move(fullpath, argpath))
                 if dircheck:
-                    lip = get_all_dirs(argpath)
-                    pli.remove(fullpath)
-                    for i in lip:
-                        pli.append(i)
+                    with index_lock:
+                        moved = move_subtree(os.path.normpath(fullpath), dest)
+                        if moved is None:
+                            index_paths([dest])
+                            moved = [dest]
+                    crawl_later(moved)
             except IOError as err:
                 print(f"Couldn't move file: {err}")
         elif com == 'copyto':
             try:
-                if os.path.isfile(fullpath):
-                    shutil.copy2(fullpath, argpath)
-                elif os.path.isdir(fullpath):
-                    shutil.copytree(fullpath, argpath)
-                    lip = get_all_dirs(argpath)
-                    for i in lip:
-                        pli.append(i)
+                entry = get_entry(fullpath)
+                if entry is None:
+                    pass
+                elif not entry.is_dir:
+                    if os.path.isdir(argpath):
+                        argpath = os.path.join(argpath, os.path.basename(fullpath))
+                    if os.path.exists(argpath) and os.path.samefile(fullpath, argpath):
+                        raise shutil.SameFileError(f"'{fullpath}' and '{argpath}' are the same file")
+                    copy_paths(fullpath, argpath)
+                else:
+                    if os.path.exists(argpath):
+                        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), argpath)
+                    task = copy_paths(fullpath, argpath)
+                    dest = os.path.normpath(argpath)
+                    if not os.path.isdir(dest):
+                        return
+                    with index_lock:
+                        # A cancelled copy is partial, so it is crawled rather than cloned
+                        queued = None if task.cancel.is_set() else clone_subtree(os.path.normpath(fullpath), dest)
+                        if queued is None:
+                            index_paths([dest])
+                            queued = [dest]
+                    crawl_later(queued)
             except IOError as err:
                 print(f"Couldn't move file: {err}")
         elif com == 'editor':
@@ -474,15 +3175,22 @@ def tokenize_(tokens, currpath, cmdli):
         elif com == 'newdir':
             try:
                 os.mkdir(fullpath)
-                pli.append(fullpath)
-                update_leaves()
+                with index_lock:
+                    index_paths([os.path.normpath(fullpath)])
             except IOError as e:
                 print(f"Couldn't create directory: {e}")
         elif com == 'list':
-            out = '\n\r'.join(os.listdir(fullpath)) + '\n\n\r'
+            if getdirs(fullpath) == ["ERROR%"]:
+                return
+            out = '\n\r'.join(e.label() for e in dirs_first(fullpath)) + '\n\n\r'
         elif com == 'info':
+            # ctime and atime are not kept in the record, and in-place writes leave the parent's mtime alone
             stats = os.stat(fullpath)
+            entry = get_entry(fullpath)
+            if entry is not None:
+                entry.size, entry.mtime = stats.st_size, stats.st_mtime
             out = f'''Name:     {file_or_dir}\r
+Type:          {'Directory' if stat.S_ISDIR(stats.st_mode) else 'File'}\r
 Size (KB):     {sizeFormat(stats.st_size)}\r
 Created:       {timeConvert(stats.st_ctime)}\r
 Modified:      {timeConvert(stats.st_mtime)}\r
@@ -490,22 +3198,22 @@ Last accessed: {timeConvert(stats.st_atime)}\r\n\n\r'''
         
         elif com == 'remove':
             try:
-                if os.path.isfile(fullpath):
+                entry = get_entry(fullpath)
+                if entry is None:
+                    pass
+                elif not entry.is_dir:
                     os.remove(fullpath)
-                elif os.path.isdir(fullpath):
+                else:
                     os.rmdir(fullpath)
-                    pli.remove(fullpath)
-                    update_leaves()
+                    with index_lock:
+                        drop_subtrees([os.path.normpath(fullpath)])
             except IOError as e:
                 print(f"Couldn't remove file or dir: {e}")
         elif com == 'purge':
             try:
-                lip = get_all_dirs(fullpath)
                 shutil.rmtree(fullpath)
-                pli.remove(fullpath)
-                for i in lip:
-                    pli.remove(i)
-                update_leaves()
+                with index_lock:
+                    drop_subtrees([os.path.normpath(fullpath)])
             except IOError as e:
                 print(f"Couldn't purge dir: {e}")
         elif com == 'run':
@@ -514,25 +3222,35 @@ Last accessed: {timeConvert(stats.st_atime)}\r\n\n\r'''
                     sys.stdout.write(f"File '{file_or_dir}' does not exist.\n\r")
                     sys.stdout.flush()
                     return
-                if os.path.isdir(fullpath):
+                entry = get_entry(fullpath)
+                if entry is not None and entry.is_dir:
                     sys.stdout.write(f"'{file_or_dir}' is a directory. Cannot run.\n\r")
                     sys.stdout.flush()
                     return
                 
                 file_extension = os.path.splitext(fullpath)[1]
                 if file_extension in file_runners:
-                    runner = file_runners[file_extension]
-                    if file_extension in ['.cpp', '.c', '.f90']:
-                        command = f'{runner} {fullpath}'
-                    else:
-                        command = f'{runner} {fullpath}'
-                    run_script_in_new_terminal(command)
+                    runner = script_runner(fullpath)
+                    if runner is None:
+                        return
+                    run_command(runner[0], background, runner[1])
                 else:
                     sys.stdout.write(f"Unsupported file type. Supported extensions are: {', '.join(file_runners.keys())}\n\r")
                     sys.stdout.flush()
                     return
             except subprocess.CalledProcessError as e:
                 print(f"Failed to run file: {e}")
+        elif com == 'watch':
+            entry = get_entry(fullpath)
+            if entry is None or entry.is_dir:
+                sys.stdout.write(f"'{file_or_dir}' is not a file. Cannot watch.\n\r")
+                sys.stdout.flush()
+                return
+            if os.path.splitext(fullpath)[1] not in file_runners:
+                sys.stdout.write(f"Unsupported file type. Supported extensions are: {', '.join(file_runners.keys())}\n\r")
+                sys.stdout.flush()
+                return
+            watch_script(fullpath, [os.path.normpath(fullpath)] + also_watch)
         else:
             sys.stdout.write("Missing command arg(s)\n\r")
             sys.stdout.flush()
@@ -550,16 +3268,6 @@ def sizeFormat(size):
     newform = format(size/1024, ".2f")
     return newform + " KB"
 
-def check_vars(va, vlist):
-    vli = []
-    for v in vlist:
-        if v.startswith(va):
-            vli.append(v)
-    others = [x for x in vlist if x not in vli and va in x]
-    vli.sort()
-    vli.extend(others)
-    return vli
-
 def check_var_in(query, command):
     global vars
     tokens = query+command
@@ -613,144 +3321,223 @@ def get_input(pathlist, currpath):
     v = ''
     history = read_history()
     history_index = len(history)
-    global cmdlist, vars, pli, leaves
+    threading.Thread(target=sync_history_search, daemon=True).start()
+    search = None
+    hits = []
+    pick = 0
+    global cmdlist, vars, leaves
     var_in = False
     varli = []
     vli = []
+    path_session = MatchSession(pathlist, presorted=True)
+    path_scores = child_scores(currpath, pathlist)
+    path_records = listing_cache.records(currpath)
+    leaf_session = MatchSession(presorted=True, seed=leaf_candidates, version=lambda: leaves_version)
+    signal.signal(signal.SIGWINCH, renderer.resize)
     try:
         hide_cursor()
         tty.setraw(fd)
+        # Bracketed paste: the terminal wraps pasted text in ESC[200~ ... ESC[201~
+        sys.stdout.write('\033[?2004h')
         while True:
-            char = sys.stdin.read(1)
-
-            if char == '\n' or char == '\r':
-                sys.stdout.write('\n\r')
-                if query == '--help':
-                    help_()
-                    tokens = '--help'
-                elif query.strip().startswith('->'):
-                    if paths:
-                        tokens = ''.join(list(paths[0]))
-                    else:
-                        tokens = query.split('->')[1]
-                    tokens = tokens.strip()
-                    if vli != []:
-                        tokens = tokens + ''.join(list(vli[0]))
-                    for i, j in vars.items():
-                        tokens = tokens.replace(i, j)
-                    matchli = []
-                    for i in pli:
-                        dirname = i.split('/')[-1]
-                        if tokens == dirname:
-                            matchli.append(i)
-                    if len(matchli) == 1:
-                        currpath = matchli[0]
-                    elif len(matchli) < 1:
-                        sys.stdout.write(f"Either '{tokens}' doesn't exist or scan/read permission is denied\n\r")
-                        sys.stdout.write("If directory does exist and is accessible, navigate to it\n\r")
-                        sys.stdout.flush()
-                    elif len(matchli) > 1:
-                        sys.stdout.write("\n\r" + "\n\n\r".join(matchli)+"\n\n\r")
-                        sys.stdout.write(f"{len(matchli)} matches found. Go to parent directory to ensure proper jump\n\r")
-                        sys.stdout.flush()
-                    tokens = '->'+tokens
-                elif '::' in query:
-                    if vli != []:
-                        tokens = query + command + ''.join(list(vli[0]))
-                        vli = []
-                    elif comli:
-                        tokens = query + ''.join(list(comli[0]))
-                    else:
-                        tokens = query + command
-                    tokenize_(tokens, currpath, cmdlist)
-                elif query == "..":
-                    currpath = os.path.dirname(currpath)
-                    tokens = '..'
-                elif query.strip() == "":
-                    pass
-                else:
-                    query = query + ''.join(varli)
-                    paths = check_dirs(query, pathlist)
-                    if paths:
-                        tokens = ''.join(list(paths[0]))
-                    else:
-                        tokens = query
-
-                    try:
-                        currpath = os.path.join(currpath, tokens)
-                    except OSError as e:
-                        sys.stdout.write(f"{e}\n\r")
-                        sys.stdout.flush()
-                        currpath = os.path.dirname(currpath)
-
-                    if os.path.exists(currpath) == False:
-                        sys.stdout.write(f"'{tokens}' doesn't exist\n\r")
-                        sys.stdout.flush()
+            # Frames are held back while more keys are already queued
+            if renderer.due() or not select.select([fd], [], [], 0)[0]:
+                renderer.flush()
+            renderer.idle = True
+            # Background jobs that finish wake the loop to report above the prompt
+            ready = select.select([fd, job_wakeup[0]], [], [])[0]
+            if job_wakeup[0] in ready:
+                job_notices()
+            if fd not in ready:
+                continue
+            keys = read_keys(fd)
+            renderer.idle = False
+            if keys is None:
+                break
+            for ki, char in enumerate(keys):
+                # Suggestions are only recomputed for the last key of a chunk
+                # and before the keys that act on them (Tab, Enter)
+                settle = ki == len(keys) - 1 or keys[ki + 1] in ('\r', '\n', '\t')
+
+                if char == '\x12' or search is not None:
+                    # Ctrl-R searches the whole history; Ctrl-R again steps to
+                    # the next match, Enter/Tab takes it, Ctrl-G/Ctrl-C cancel
+                    if search is None:
+                        sync_history_search()
+                        search = []
+                        hits = search_history('')
+                        pick = 0
+                    elif char == '\x12':
+                        if hits is None:
+                            hits = search_history(''.join(search))
+                            pick = -1
+                        if hits:
+                            pick = (pick + 1) % len(hits)
+                    elif char in ('\r', '\n', '\t'):
+                        if hits:
+                            query = hits[pick]
+                            command = ''
+                            if '::' in query:
+                                queryli = query.split('::')
+                                query = queryli[0].strip() + '::'
+                                command = queryli[1].strip()
+                            input_chars = list(query)
+                            cmd_chars = list(command)
+                            var_in = False
+                            varli = []
+                            vli = []
+                        history_index = len(history)
+                        search = None
+                    elif char in ('\x07', '\x03'):
+                        search = None
+                    elif char in ('\x7f', '\b'):
+                        if search:
+                            search.pop()
+                            hits = None
+                    elif char >= ' ' and not char.startswith('\x1b'):
+                        search.append(char)
+                        hits = None
+
+                    if search is not None:
+                        if settle:
+                            if hits is None:
+                                hits = search_history(''.join(search))
+                                pick = 0
+                            display_history(''.join(search), hits, pick)
+                        continue
+
+                elif char == '\n' or char == '\r':
+                    renderer.flush()
+                    sys.stdout.write('\n\r')
+                    prevpath = currpath
+                    if query == '--help':
+                        help_()
+                        tokens = '--help'
+                    elif query.strip().startswith('->'):
+                        if paths:
+                            tokens = ''.join(list(paths[0]))
+                        else:
+                            tokens = query.split('->')[1]
+                        tokens = tokens.strip()
+                        if vli != []:
+                            tokens = tokens + ''.join(list(vli[0]))
+                        for i, j in vars.items():
+                            tokens = tokens.replace(i, j)
+                        matchli = [node_path(n) for n in leaf_nodes.get(tokens, ())]
+                        if len(matchli) == 1:
+                            currpath = matchli[0]
+                        elif len(matchli) < 1:
+                            sys.stdout.write(f"Either '{tokens}' doesn't exist or scan/read permission is denied\n\r")
+                            sys.stdout.write("If directory does exist and is accessible, navigate to it\n\r")
+                            sys.stdout.flush()
+                        elif pick_frecent(matchli):
+                            currpath = pick_frecent(matchli)
+                            sys.stdout.write(f"{len(matchli)} matches found, jumping to most frecent: {currpath}\n\r")
+                            sys.stdout.flush()
+                        elif len(matchli) > 1:
+                            sys.stdout.write("\n\r" + "\n\n\r".join(matchli)+"\n\n\r")
+                            sys.stdout.write(f"{len(matchli)} matches found. Go to parent directory to ensure proper jump\n\r")
+                            sys.stdout.flush()
+                        tokens = '->'+tokens
+                    elif '::' in query:
+                        if vli != []:
+                            tokens = query + command + ''.join(list(vli[0]))
+                            vli = []
+                        elif comli:
+                            tokens = query + ''.join(list(comli[0]))
+                        else:
+                            tokens = query + command
+                        tokenize_(tokens, currpath, cmdlist)
+                    elif query == "..":
                         currpath = os.path.dirname(currpath)
+                        tokens = '..'
+                    elif query.strip() == "":
+                        pass
+                    else:
+                        query = query + ''.join(varli)
+                        paths = suggest_paths(query, path_session, path_scores)
+                        if paths:
+                            tokens = ''.join(list(paths[0]))
+                        else:
+                            tokens = query
 
-                    if os.path.isfile(currpath):
                         try:
-                            subprocess.run(f"open {currpath}", shell=True, text=True)
-                        except subprocess.CalledProcessError as e:
-                            sys.stdout.write(f"Failed to open file: {e}\n\r")
+                            currpath = os.path.join(currpath, tokens)
+                        except OSError as e:
+                            sys.stdout.write(f"{e}\n\r")
                             sys.stdout.flush()
-                        currpath = os.path.dirname(currpath)
+                            currpath = os.path.dirname(currpath)
+
+                        if os.path.exists(currpath) == False:
+                            sys.stdout.write(f"'{tokens}' doesn't exist\n\r")
+                            sys.stdout.flush()
+                            currpath = os.path.dirname(currpath)
+
+                        entry = get_entry(currpath)
+                        if entry is not None and not entry.is_dir:
+                            try:
+                                subprocess.run(f"open {currpath}", shell=True, text=True)
+                            except subprocess.CalledProcessError as e:
+                                sys.stdout.write(f"Failed to open file: {e}\n\r")
+                                sys.stdout.flush()
+                            currpath = os.path.dirname(currpath)
 
-                if tokens.strip() != "":
-                    history = write_history(tokens)
-                    history_index = len(history)
+                    if tokens.strip() != "":
+                        history = write_history(tokens)
+                        history_index = len(history)
 
-                pathlist = update_path(currpath)
-                if pathlist == ["ERROR%"]:
-                    currpath = os.path.dirname(currpath)
                     pathlist = update_path(currpath)
-                input_chars = []
-                cmd_chars = []
-                varli = []
-                vli = []
-                tokens = ''
-                query = ''
-                paths = []
+                    if pathlist == ["ERROR%"]:
+                        currpath = os.path.dirname(currpath)
+                        pathlist = update_path(currpath)
+                    path_session = MatchSession(pathlist, presorted=True)
+                    if currpath != prevpath:
+                        record_visit(currpath)
+                    path_scores = child_scores(currpath, pathlist)
+                    path_records = listing_cache.records(currpath)
+                    input_chars = []
+                    cmd_chars = []
+                    varli = []
+                    vli = []
+                    tokens = ''
+                    query = ''
+                    paths = []
                 
-                sys.stdout.write('\r\0337')
-                sys.stdout.flush()
-                display = display_pathlist(query, paths, currpath)
-                sys.stdout.write('\r\0337')
-                sys.stdout.flush()
+                    renderer.anchor()
+                    display = display_pathlist(query, paths, currpath)
+                    renderer.flush()
 
-                continue
+                    continue
 
-            elif char == '\x7f' or char == '\b':
-                if varli != []:
-                    varli.pop()
-                elif cmd_chars != []:
-                    cmd_chars.pop()
-                elif cmd_chars == [] and input_chars!= []:
-                    input_chars.pop()
-                elif cmd_chars == [] and input_chars== []:
-                    pass
+                elif char == '\x7f' or char == '\b':
+                    if varli != []:
+                        varli.pop()
+                    elif cmd_chars != []:
+                        cmd_chars.pop()
+                    elif cmd_chars == [] and input_chars!= []:
+                        input_chars.pop()
+                    elif cmd_chars == [] and input_chars== []:
+                        pass
             
-            elif char == '\t':
-                if var_in == True:
-                    if vli:
-                        varli = list(vli[0])
-                        vli = []
-                elif '::' in query:
-                    if comli:
-                        cmd_chars = list(comli[0])
-                        comli = []
-                else:
-                    if paths:
-                        if query.strip().startswith('->'):
-                            input_chars = list('->'+paths[0])
-                        else:
-                            input_chars = list(paths[0])
-                        paths = []
+                elif char == '\t':
+                    if var_in == True:
+                        if vli:
+                            varli = list(vli[0])
+                            vli = []
+                    elif '::' in query:
+                        if comli:
+                            cmd_chars = list(comli[0])
+                            comli = []
+                    else:
+                        if paths:
+                            if query.strip().startswith('->'):
+                                input_chars = list('->'+paths[0])
+                            else:
+                                input_chars = list(paths[0])
+                            paths = []
 
-            elif char == '\x1b':
-                next1, next2 = sys.stdin.read(1), sys.stdin.read(1)
-                if next1 == '[':
-                    if next2 == 'A':  # Up arrow
+                elif char in ('\x1b[A', '\x1bOA', '\x1b[B', '\x1bOB'):
+                    if char[2] == 'A':  # Up arrow
                         if history_index > 0:
                             history_index -= 1
                             query = history[history_index].strip('\n')
@@ -766,7 +3553,7 @@ def get_input(pathlist, currpath):
                             query = ''
                             input_chars = []
                             cmd_chars = []
-                    elif next2 == 'B':  # Down arrow
+                    else:  # Down arrow
                         if history_index < len(history) - 1:
                             history_index += 1
                             query = history[history_index].strip('\n')
@@ -783,114 +3570,120 @@ def get_input(pathlist, currpath):
                             input_chars = []
                             cmd_chars = []
 
-                    if '::' in query and query.strip().startswith('->')==False:
+                    if settle and '::' in query and query.strip().startswith('->')==False:
                         if command.strip() == '':
                             comli = []
                         else:
-                            comli = check_cmd(command, cmdlist)
+                            comli = fuzzy_rank(command, cmdlist) if fuzzy else top_matches(command, cmdlist, presorted=True)
 
                         display = display_pathlist(query, [], currpath)
                         display_cmdlist(command, comli, display)
-                    else:
+                    elif settle:
                         if query.strip() == '':
                             paths = []
                         elif query.strip().startswith('->'):
                             if query.strip() == '->':
                                 paths = []
                             else:
-                                paths = check_all_dirs(query[2:], leaves)
+                                paths = suggest_leaves(query[2:], leaf_session)
                         else:
-                            paths = check_dirs(query, pathlist)
-                        display = display_pathlist(query, paths, currpath)
+                            paths = suggest_paths(query, path_session, path_scores)
+                        display = display_pathlist(query, paths, currpath, None if query.strip().startswith('->') else path_records)
 
                     continue
-                else:
-                    continue
 
-            elif char == '$':
-                varli.append(char)
-                var_in = True
+                elif char.startswith('\x1b'):
+                    continue
 
-            else:
-                if var_in  == True:
+                elif char == '$':
                     varli.append(char)
-                elif var_in == False:
-                    if '::' in query:
-                        cmd_chars.append(char)
-                    else:
-                        input_chars.append(char)
-
-            if query.strip().startswith('->'):
-                cmd_chars = []
-
-            query = ''.join(input_chars)
-            command = ''.join(cmd_chars)
-            v = ''.join(varli)
-
-            if var_in == False:
-                v, varli, var_in, query, command, input_chars, cmd_chars = check_var_in(query, command)
-
-            if var_in == True:
-                qq = currpath + '%||%' + query + command if query or command else currpath + '%||%'
-                qq_curr = qq.split('%||%')
-                par, chi = qq_curr[-2], qq_curr[-1]
-                parli = par.split('/')
-                par = parli[-2].strip() + '/' + parli[-1].strip()
-                display = f'{par}/{chi}'
-                vli = check_vars(v, vars.keys())
-                display_varlist(v, vli, display)
-                if not vli or v.strip() == '':
-                    if '::' in query:
-                        cmd_chars.extend(list(v))
-                    else:
-                        input_chars.extend(list(v))
-                    var_in = False
-                    varli = []
-                    vli = []
-                    v = ''
-                    query = ''.join(input_chars)
-                    command = ''.join(cmd_chars)
-
-            if var_in == False:
-                if '::' in query and query.strip().startswith('->')==False:
-                    if command.strip() == '':
-                        comli = []
-                    else:
-                        comli = check_cmd(command, cmdlist)
+                    var_in = True
 
-                    display = display_pathlist(query, [], currpath)
-                    display_cmdlist(command, comli, display)
                 else:
-                    if query.strip() == '':
-                        paths = []
-                    elif query.strip().startswith('->'):
-                        if query.strip() == '->':
-                            paths = []
+                    if var_in  == True:
+                        varli.append(char)
+                    elif var_in == False:
+                        if '::' in query:
+                            cmd_chars.append(char)
+                        else:
+                            input_chars.append(char)
+
+                if query.strip().startswith('->'):
+                    cmd_chars = []
+
+                query = ''.join(input_chars)
+                command = ''.join(cmd_chars)
+                v = ''.join(varli)
+
+                if var_in == False:
+                    v, varli, var_in, query, command, input_chars, cmd_chars = check_var_in(query, command)
+
+                if var_in == True:
+                    qq = currpath + '%||%' + query + command if query or command else currpath + '%||%'
+                    qq_curr = qq.split('%||%')
+                    par, chi = qq_curr[-2], qq_curr[-1]
+                    parli = par.split('/')
+                    par = parli[-2].strip() + '/' + parli[-1].strip()
+                    display = f'{par}/{chi}'
+                    vli = top_matches(v, vars)
+                    display_varlist(v, vli, display)
+                    if not vli or v.strip() == '':
+                        if '::' in query:
+                            cmd_chars.extend(list(v))
                         else:
-                            paths = check_all_dirs(query[2:], leaves)
+                            input_chars.extend(list(v))
+                        var_in = False
+                        varli = []
+                        vli = []
+                        v = ''
+                        query = ''.join(input_chars)
+                        command = ''.join(cmd_chars)
+
+                if var_in == False and settle:
+                    if '::' in query and query.strip().startswith('->')==False:
+                        if command.strip() == '':
+                            comli = []
+                        else:
+                            comli = fuzzy_rank(command, cmdlist) if fuzzy else top_matches(command, cmdlist, presorted=True)
+
+                        display = display_pathlist(query, [], currpath)
+                        display_cmdlist(command, comli, display)
                     else:
-                        paths = check_dirs(query, pathlist)
-                    display = display_pathlist(query, paths, currpath)
+                        if query.strip() == '':
+                            paths = []
+                        elif query.strip().startswith('->'):
+                            if query.strip() == '->':
+                                paths = []
+                            else:
+                                paths = suggest_leaves(query[2:], leaf_session)
+                        else:
+                            paths = suggest_paths(query, path_session, path_scores)
+                        display = display_pathlist(query, paths, currpath, None if query.strip().startswith('->') else path_records)
 
 
     finally:
+        sys.stdout.write('\033[?2004l')
+        signal.signal(signal.SIGWINCH, signal.SIG_DFL)
         show_cursor()
         termios.tcsetattr(fd, termios.TCSADRAIN, original_settings)
 
 def main():
-    global pli
     os.system('clear')
     print("JOEMAMA 2.6")
     print("Use `--help` for more information\n")
     currpath = os.path.expanduser("~")
-    pli = get_all_dirs(currpath)
-    pli.append(os.path.expanduser("~"))
-    update_leaves()
+    build_index(currpath)
+    open_frecency()
     pathlist = update_path(currpath)
-    sys.stdout.write('\0337')
-    sys.stdout.flush()
-    sys.stdout.write(currpath.strip('/'))
-    get_input(pathlist, currpath)
+    renderer.anchor()
+    renderer.draw(currpath.strip('/'))
+    renderer.flush()
+    try:
+        get_input(pathlist, currpath)
+    finally:
+        flush_frecency()
+        with index_lock:
+            save_index(crawl_pending)
 
 if __name__ == '__main__':
     main()